@@ -0,0 +1,129 @@
+"""Run the benchmarks and track results over time.
+
+    PYTHONPATH=src python -m benchmarks [--scale full] [--filter group]
+
+Each run appends its results to a JSON lines history file and is compared
+with the last run recorded on the same host and Python version; benchmarks
+slower than the threshold are reported and make the run exit with status 1.
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+from benchmarks.suite import BENCHMARKS, SCALES, default_workdir
+
+HISTORY = Path(__file__).parent / "history.jsonl"
+
+
+def measure(func, repeat: int, min_time: float = 0.2) -> list[float]:
+    """Time func like timeit, returning the seconds per call of each repeat."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return [elapsed / number for elapsed in timer.repeat(repeat, number)]
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_run(history: Path, host: str, python: str) -> dict | None:
+    if not history.exists():
+        return None
+    previous = None
+    with history.open() as f:
+        for line in f:
+            run = json.loads(line)
+            if run["host"] == host and run["python"] == python:
+                previous = run
+    return previous
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="qb-router benchmarks")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--filter", default="", help="only run matching names")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--history", type=Path, default=HISTORY)
+    parser.add_argument("--no-record", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="relative slowdown of the median reported as a regression",
+    )
+    parser.add_argument("--workdir", default=default_workdir())
+    args = parser.parse_args()
+
+    host, python = platform.node(), platform.python_version()
+    previous = last_run(args.history, host, python)
+    previous_results = previous["results"] if previous else {}
+
+    results = {}
+    regressions = []
+    for name, (setup, params) in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        for param in SCALES[args.scale][params]:
+            key = f"{name}[{param}]"
+            workdir = Path(tempfile.mkdtemp(prefix="qbrouter-bench-", dir=args.workdir))
+            try:
+                func = setup(param, workdir)
+                timings = measure(func, args.repeat)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+            results[key] = {
+                "min": min(timings),
+                "median": statistics.median(timings),
+            }
+            line = f"{key:40} {results[key]['median'] * 1000:12.3f} ms"
+            if key in previous_results:
+                change = results[key]["median"] / previous_results[key]["median"] - 1
+                line += f" {change:+8.1%}"
+                if change > args.threshold:
+                    regressions.append(key)
+                    line += "  REGRESSION"
+            print(line, flush=True)
+
+    if not args.no_record:
+        with args.history.open("a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "revision": git_revision(),
+                        "host": host,
+                        "python": python,
+                        "scale": args.scale,
+                        "results": results,
+                    }
+                )
+                + "\n"
+            )
+
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
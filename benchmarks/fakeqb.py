@@ -0,0 +1,392 @@
+"""A simulated qBittorrent WebUI server implementing the endpoints qb-router
+calls, backed by a local data directory.
+
+Torrents are dicts shaped like sync/maindata reports them. Free disk space is a
+configured disk size minus the size of the distinct files of the torrents held,
+minus ``fill_rate`` bytes per second of simulated downloads. Added torrents are
+checked against the data directory after ``check_time`` seconds unless added
+with skip_checking. Every request waits ``latency`` (plus up to ``jitter``)
+seconds and is counted per endpoint, see ``GET /stats``.
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections import Counter
+from functools import cache
+
+from aiohttp import web
+
+from qbrouter.utils.bencode import bdecode, bencode
+
+PIECE_LENGTH = 16777216
+
+
+@cache
+def _zero_piece_hash(length: int) -> bytes:
+    return hashlib.sha1(bytes(length)).digest()
+
+
+def make_torrent(
+    name: str, files: list[dict], save_path: str, piece_length: int = PIECE_LENGTH
+) -> tuple[dict, bytes]:
+    """Build the torrent dict and v1 metainfo of a multi-file torrent whose
+    files (name relative to the torrent root, size) are all zeros, like sparse
+    files are."""
+    total = sum(file["size"] for file in files)
+    full, last = divmod(total, piece_length)
+    pieces = _zero_piece_hash(piece_length) * full
+    if last:
+        pieces += _zero_piece_hash(last)
+    info = {
+        "name": name,
+        "piece length": piece_length,
+        "pieces": pieces,
+        "files": [
+            {"length": file["size"], "path": file["name"].split("/")} for file in files
+        ],
+    }
+    metainfo = bencode({"info": info})
+    torrent = {
+        "hash": hashlib.sha1(bencode(info)).hexdigest(),
+        "name": name,
+        "save_path": save_path,
+        "content_path": os.path.join(save_path, name),
+        "size": total,
+        "progress": 1,
+        "state": "stalledUP",
+        "tags": "",
+        "category": "",
+        "auto_tmm": False,
+        "popularity": 0.0,
+        "seeding_time": 0,
+        "uploaded": 0,
+        "added_on": int(time.time()),
+    }
+    return torrent, metainfo
+
+
+class FakeQBittorrent:
+    def __init__(
+        self,
+        save_path: str,
+        data_root: str,
+        disk_size: int,
+        latency: float = 0,
+        jitter: float = 0,
+        fill_rate: int = 0,
+        check_time: float = 1,
+    ):
+        # Torrents are added with the save path of the source, map it to ours
+        self.save_path = save_path.rstrip("/")
+        self.data_root = data_root
+        self.disk_size = disk_size
+        self.latency = latency
+        self.jitter = jitter
+        self.fill_rate = fill_rate
+        self.check_time = check_time
+        self.torrents: dict[str, dict] = {}
+        self.files: dict[str, list[dict]] = {}
+        self.metainfo: dict[str, bytes] = {}
+        self.calls = Counter()
+        self.started_at = time.monotonic()
+        # sync/maindata revision of every torrent and of removals
+        self.rid = 1
+        self.revisions: dict[str, int] = {}
+        self.removed: list[tuple[int, str]] = []
+        self._inodes = {}
+        self._checks = set()
+        self._runner: web.AppRunner | None = None
+
+    def add(self, torrent: dict, metainfo: bytes):
+        torrent_hash = torrent["hash"]
+        info = bdecode(metainfo)[b"info"]
+        self.torrents[torrent_hash] = torrent
+        self.metainfo[torrent_hash] = metainfo
+        self.files[torrent_hash] = [
+            {
+                "index": index,
+                "name": "/".join(
+                    [info[b"name"].decode()] + [part.decode() for part in file[b"path"]]
+                ),
+                "size": file[b"length"],
+                "progress": torrent["progress"],
+                "priority": 1,
+            }
+            for index, file in enumerate(info[b"files"])
+        ]
+        self._touch(torrent_hash)
+
+    def _touch(self, torrent_hash: str):
+        self.rid += 1
+        self.revisions[torrent_hash] = self.rid
+
+    def _local(self, torrent: dict, file: dict) -> str:
+        path = os.path.join(torrent["save_path"], file["name"])
+        return self.data_root + path[len(self.save_path) :]
+
+    def _inode(self, path: str):
+        # Hardlinked cross-seeds take the space of their files once
+        if path not in self._inodes:
+            try:
+                st = os.stat(path)
+                self._inodes[path] = (st.st_dev, st.st_ino)
+            except OSError:
+                return path
+        return self._inodes[path]
+
+    def used_space(self) -> int:
+        sizes = {
+            self._inode(self._local(torrent, file)): file["size"]
+            for torrent_hash, torrent in self.torrents.items()
+            for file in self.files[torrent_hash]
+        }
+        return sum(sizes.values())
+
+    def free_space(self) -> int:
+        filled = self.fill_rate * (time.monotonic() - self.started_at)
+        return int(self.disk_size - self.used_space() - filled)
+
+    def server_state(self) -> dict:
+        return {
+            "free_space_on_disk": self.free_space(),
+            "dl_info_speed": self.fill_rate,
+            "up_info_speed": 0,
+            "up_rate_limit": 0,
+            "queued_io_jobs": 0,
+            "average_time_queue": 0,
+            "read_cache_overload": "0",
+            "write_cache_overload": "0",
+        }
+
+    def _select(self, hashes: str | None) -> list[str]:
+        if not hashes or hashes == "all":
+            return list(self.torrents)
+        return [h for h in hashes.split("|") if h in self.torrents]
+
+    def _set_running(self, hashes: str, running: bool):
+        for torrent_hash in self._select(hashes):
+            torrent = self.torrents[torrent_hash]
+            if running:
+                torrent["state"] = (
+                    "stalledUP" if torrent["progress"] >= 1 else "stalledDL"
+                )
+            else:
+                torrent["state"] = (
+                    "stoppedUP" if torrent["progress"] >= 1 else "stoppedDL"
+                )
+            self._touch(torrent_hash)
+
+    async def _check(self, torrent_hash: str, stopped: bool):
+        await asyncio.sleep(self.check_time)
+        torrent = self.torrents.get(torrent_hash)
+        if torrent is None:
+            return
+        present = 0
+        for file in self.files[torrent_hash]:
+            try:
+                if os.stat(self._local(torrent, file)).st_size == file["size"]:
+                    present += file["size"]
+            except OSError:
+                pass
+        torrent["progress"] = present / torrent["size"] if torrent["size"] else 1
+        for file in self.files[torrent_hash]:
+            file["progress"] = torrent["progress"]
+        self._set_running(torrent_hash, not stopped)
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        if request.path == "/stats":
+            return await handler(request)
+        self.calls[request.path.removeprefix("/api/v2/")] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        return await handler(request)
+
+    async def login(self, request: web.Request):
+        response = web.Response(text="Ok.")
+        response.set_cookie("SID", "fake")
+        return response
+
+    async def default_save_path(self, request: web.Request):
+        return web.Response(text=self.save_path)
+
+    async def maindata(self, request: web.Request):
+        rid = int(request.query.get("rid", 0))
+        if not rid:
+            return web.json_response(
+                {
+                    "rid": self.rid,
+                    "full_update": True,
+                    "torrents": self.torrents,
+                    "server_state": self.server_state(),
+                }
+            )
+        return web.json_response(
+            {
+                "rid": self.rid,
+                "torrents": {
+                    torrent_hash: self.torrents[torrent_hash]
+                    for torrent_hash, revision in self.revisions.items()
+                    if revision > rid
+                },
+                "torrents_removed": [
+                    h for revision, h in self.removed if revision > rid
+                ],
+                "server_state": self.server_state(),
+            }
+        )
+
+    async def torrents_info(self, request: web.Request):
+        return web.json_response(
+            [self.torrents[h] for h in self._select(request.query.get("hashes"))]
+        )
+
+    async def torrents_files(self, request: web.Request):
+        torrent_hash = request.query.get("hash")
+        if torrent_hash not in self.files:
+            raise web.HTTPNotFound(text="Torrent hash was not found")
+        return web.json_response(self.files[torrent_hash])
+
+    async def torrents_export(self, request: web.Request):
+        torrent_hash = request.query.get("hash")
+        if torrent_hash not in self.metainfo:
+            raise web.HTTPNotFound(text="Torrent hash was not found")
+        return web.Response(
+            body=self.metainfo[torrent_hash], content_type="application/x-bittorrent"
+        )
+
+    async def torrents_add(self, request: web.Request):
+        form = await request.post()
+        metainfo = form["torrents"].file.read()
+        info = bdecode(metainfo)[b"info"]
+        torrent_hash = hashlib.sha1(bencode(info)).hexdigest()
+        if torrent_hash in self.torrents:
+            return web.Response(text="Fails.")
+
+        save_path = form.get("savepath") or self.save_path
+        skip_checking = form.get("skip_checking") == "true"
+        stopped = form.get("stopped") == "true" or form.get("paused") == "true"
+        torrent, _ = make_torrent(
+            info[b"name"].decode(),
+            [
+                {
+                    "name": "/".join(part.decode() for part in file[b"path"]),
+                    "size": file[b"length"],
+                }
+                for file in info[b"files"]
+            ],
+            save_path,
+            info[b"piece length"],
+        )
+        torrent.update(
+            tags=form.get("tags", ""),
+            category=form.get("category", ""),
+            auto_tmm=form.get("autoTMM") == "true",
+            progress=1 if skip_checking else 0,
+            state="checkingUP",
+        )
+        self.add(torrent, metainfo)
+
+        if skip_checking:
+            self._set_running(torrent_hash, not stopped)
+        else:
+            check = asyncio.create_task(self._check(torrent_hash, stopped))
+            self._checks.add(check)
+            check.add_done_callback(self._checks.discard)
+        return web.Response(text="Ok.")
+
+    async def torrents_stop(self, request: web.Request):
+        self._set_running((await request.post()).get("hashes"), False)
+        return web.Response()
+
+    async def torrents_start(self, request: web.Request):
+        self._set_running((await request.post()).get("hashes"), True)
+        return web.Response()
+
+    async def torrents_delete(self, request: web.Request):
+        form = await request.post()
+        delete_files = form.get("deleteFiles") == "true"
+        for torrent_hash in self._select(form.get("hashes")):
+            torrent = self.torrents.pop(torrent_hash)
+            files = self.files.pop(torrent_hash)
+            del self.metainfo[torrent_hash]
+            del self.revisions[torrent_hash]
+            self.rid += 1
+            self.removed.append((self.rid, torrent_hash))
+            if delete_files:
+                self._delete_files(torrent, files)
+        return web.Response()
+
+    def _delete_files(self, torrent: dict, files: list[dict]):
+        directories = set()
+        for file in files:
+            path = self._local(torrent, file)
+            self._inodes.pop(path, None)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            directories.add(os.path.dirname(path))
+        # Remove the directories left empty, up to the data root
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory.startswith(self.data_root + "/"):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    async def torrents_add_tags(self, request: web.Request):
+        form = await request.post()
+        new = [tag.strip() for tag in form.get("tags", "").split(",") if tag.strip()]
+        for torrent_hash in self._select(form.get("hashes")):
+            torrent = self.torrents[torrent_hash]
+            tags = [t.strip() for t in torrent["tags"].split(",") if t.strip()]
+            torrent["tags"] = ", ".join(sorted(set(tags + new)))
+            self._touch(torrent_hash)
+        return web.Response()
+
+    async def stats(self, request: web.Request):
+        return web.json_response(
+            {
+                "calls": self.calls,
+                "torrents": len(self.torrents),
+                "free_space_on_disk": self.free_space(),
+            }
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes(
+            [
+                web.post("/api/v2/auth/login", self.login),
+                web.get("/api/v2/app/defaultSavePath", self.default_save_path),
+                web.get("/api/v2/sync/maindata", self.maindata),
+                web.get("/api/v2/torrents/info", self.torrents_info),
+                web.get("/api/v2/torrents/files", self.torrents_files),
+                web.get("/api/v2/torrents/export", self.torrents_export),
+                web.post("/api/v2/torrents/add", self.torrents_add),
+                web.post("/api/v2/torrents/stop", self.torrents_stop),
+                web.post("/api/v2/torrents/start", self.torrents_start),
+                web.post("/api/v2/torrents/delete", self.torrents_delete),
+                web.post("/api/v2/torrents/addTags", self.torrents_add_tags),
+                web.get("/stats", self.stats),
+            ]
+        )
+        return app
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving on the running loop and return the base URL."""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,89 @@
+"""Synthetic data shaped like a large qBittorrent seeding box."""
+
+import os
+import random
+from pathlib import Path
+
+SAVE_PATH = "/downloads"
+
+
+def synthetic_torrents(
+    count: int, cross_seed_ratio: float = 0.3, seed: int = 0
+) -> tuple[list[dict], dict[str, list[dict]]]:
+    """Return torrents as sync/maindata reports them and their file lists.
+
+    File counts follow a long tail (most torrents have a handful of files, some
+    have hundreds). ``cross_seed_ratio`` of the torrents are cross-seeds that
+    reuse the files of an earlier torrent under another name.
+    """
+    rng = random.Random(seed)
+    torrents = []
+    files = {}
+    for i in range(count):
+        torrent_hash = f"{i:040x}"
+        name = f"Torrent.{i}.2024.1080p"
+        if torrents and rng.random() < cross_seed_ratio:
+            original = rng.choice(torrents)
+            torrent_files = files[original["hash"]]
+            cross_seed_of = original["hash"]
+        else:
+            file_count = min(int(rng.lognormvariate(1.2, 1.1)) + 1, 500)
+            torrent_files = [
+                {
+                    "name": f"{name}/Disc {j // 50}/{name}.part{j:03d}.mkv",
+                    "size": rng.randint(1 << 20, 8 << 30),
+                }
+                for j in range(file_count)
+            ]
+            cross_seed_of = None
+        tags = ["synced"] if rng.random() < 0.5 else []
+        tags += rng.sample(["tv", "movies", "linux", "music", "books"], 2)
+        torrents.append(
+            {
+                "hash": torrent_hash,
+                "name": name,
+                "save_path": SAVE_PATH,
+                "content_path": os.path.join(SAVE_PATH, name),
+                "tags": ", ".join(tags),
+                "size": sum(f["size"] for f in torrent_files),
+                "popularity": rng.random() * 10,
+                "seeding_time": rng.randint(0, 365 * 86400),
+                "progress": 1,
+                "state": "stalledUP",
+                "cross_seed_of": cross_seed_of,
+            }
+        )
+        files[torrent_hash] = torrent_files
+    return torrents, files
+
+
+def build_file_tree(root: Path, torrents: list[dict], files: dict) -> dict:
+    """Create the torrent files under root as empty files, cross-seeds being
+    hardlinks to their original. Returns hash -> list of file paths."""
+    paths = {}
+    for torrent in torrents:
+        torrent_paths = []
+        original = torrent["cross_seed_of"]
+        for index, file in enumerate(files[torrent["hash"]]):
+            path = root / torrent["hash"] / file["name"]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if original:
+                os.link(paths[original][index], path)
+            else:
+                path.touch()
+            torrent_paths.append(path)
+        paths[torrent["hash"]] = torrent_paths
+    return paths
+
+
+def build_dir_tree(root: Path, count: int, fanout: int = 12, seed: int = 0) -> int:
+    """Create count directories below root in a random tree."""
+    rng = random.Random(seed)
+    directories = [root]
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        parent = directories[rng.randrange(max(1, len(directories) // fanout))]
+        directory = parent / f"d{i}"
+        directory.mkdir()
+        directories.append(directory)
+    return count
@@ -0,0 +1,273 @@
+"""Drive the whole router against simulated qBittorrent instances.
+
+    PYTHONPATH=src python -m benchmarks.load --torrents 500 --free 100
+
+Torrents are sparse files in a scratch source directory, presynced (same size
+and mtime) to the destination directories unless --no-presync is given, so
+the run measures the tag and move pipeline rather than copying. The source
+starts --free GB below the router's --min-space; the run ends once that space
+is freed or after --timeout seconds, and reports the time it took, the API
+calls per router loop and the peak memory of the router process. The fake
+servers run in a child process so they do not share the router's event loop
+or memory.
+
+Arguments after ``--`` are passed to the router, e.g. ``-- --verify-mode
+pieces``.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.fakeqb import FakeQBittorrent, make_torrent
+from benchmarks.suite import default_workdir
+from qbrouter import get_config
+from qbrouter.tasks import get_tasks
+from qbrouter.utils.metrics import PASS_DURATION
+
+GB = 1073741824
+
+# A year of seeding, above any --min-seeding-time
+SEEDING_TIME = 31536000
+
+
+def populate(args, src_root: str, dest_roots: list[str]) -> list[tuple]:
+    """Create the torrent data and return the (torrent, metainfo) to seed."""
+    rng = random.Random(args.seed)
+    mtime = time.time() - SEEDING_TIME
+    torrents = []
+    for i in range(args.torrents):
+        name = f"Torrent.{i}.2024.1080p"
+        dest_root = dest_roots[i % len(dest_roots)]
+        if torrents and rng.random() < args.cross_seed_ratio:
+            # A cross-seed under another name, hardlinked to an earlier torrent
+            original, _, original_files = rng.choice(torrents)
+            files = original_files
+            for root in [src_root] + ([dest_root] if args.presync else []):
+                for file in files:
+                    existing = os.path.join(root, original["name"], file["name"])
+                    path = os.path.join(root, name, file["name"])
+                    if os.path.exists(existing):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        os.link(existing, path)
+        else:
+            files = [
+                {
+                    "name": f"{name}.part{j:03d}.mkv",
+                    "size": rng.randint(args.min_size, args.max_size) * 1048576,
+                }
+                for j in range(rng.randint(1, args.files))
+            ]
+            for root in [src_root] + ([dest_root] if args.presync else []):
+                for file in files:
+                    path = os.path.join(root, name, file["name"])
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, "wb") as f:
+                        f.truncate(file["size"])
+                    os.utime(path, (mtime, mtime))
+
+        torrent, metainfo = make_torrent(name, files, src_root)
+        torrent.update(
+            popularity=rng.random() * 2,
+            seeding_time=SEEDING_TIME,
+            added_on=int(mtime),
+            tags=", ".join(rng.sample(["tv", "movies", "linux"], 1)),
+        )
+        torrents.append((torrent, metainfo, files))
+    return [(torrent, metainfo) for torrent, metainfo, _ in torrents]
+
+
+def serve(fakes: list[FakeQBittorrent], conn):
+    """Child process: serve the fakes until the parent says stop."""
+
+    async def main():
+        urls = [await fake.serve() for fake in fakes]
+        conn.send(urls)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        for fake in fakes:
+            await fake.close()
+
+    asyncio.run(main())
+
+
+async def fetch_stats(session: aiohttp.ClientSession, url: str) -> dict:
+    async with session.get(f"{url}/stats") as response:
+        return await response.json()
+
+
+def pass_count(name: str) -> int:
+    for sample, labels, value in PASS_DURATION.samples():
+        if sample.endswith("_count") and labels == f'{{name="{name}"}}':
+            return value
+    return 0
+
+
+async def drive(config, src_url: str, dest_urls: list[str], target: int, timeout):
+    tasks = [asyncio.create_task(task.run(config)) for task in get_tasks()]
+    started_at = time.monotonic()
+    freed_at = None
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - started_at < timeout:
+            stats = await fetch_stats(session, src_url)
+            if stats["free_space_on_disk"] >= target:
+                freed_at = time.monotonic() - started_at
+                break
+            await asyncio.sleep(0.25)
+
+        config.run = False
+        _, pending = await asyncio.wait(tasks, timeout=config.sleep + 10)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        src_stats = await fetch_stats(session, src_url)
+        dest_stats = [await fetch_stats(session, url) for url in dest_urls]
+    return freed_at, src_stats, dest_stats
+
+
+def report(args, freed_at, loops, src_stats, dest_stats, rss_before):
+    def calls_table(label, calls):
+        total = sum(calls.values())
+        print(f"{label} API calls: {total} ({total / max(loops, 1):.1f} per loop)")
+        for endpoint, count in sorted(calls.items(), key=lambda item: -item[1]):
+            print(f"  {endpoint:28} {count:8} {count / max(loops, 1):10.1f}")
+
+    if freed_at is None:
+        print(f"Did not free {args.free} GB within {args.timeout}s")
+    else:
+        print(f"Freed {args.free} GB in {freed_at:.2f}s")
+    print(f"Router loops: {loops}")
+    print(f"Torrents moved: {args.torrents - src_stats['torrents']} of {args.torrents}")
+    calls_table("Source", src_stats["calls"])
+    dest_calls = {}
+    for stats in dest_stats:
+        for endpoint, count in stats["calls"].items():
+            dest_calls[endpoint] = dest_calls.get(endpoint, 0) + count
+    calls_table("Destination", dest_calls)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak RSS: {peak:.1f} MB ({peak - rss_before:+.1f} MB during the run)")
+
+
+def main() -> int:
+    argv = sys.argv[1:]
+    router_args = []
+    if "--" in argv:
+        argv, router_args = argv[: argv.index("--")], argv[argv.index("--") + 1 :]
+
+    parser = argparse.ArgumentParser(description="qb-router load harness")
+    parser.add_argument("--torrents", type=int, default=200)
+    parser.add_argument("--files", type=int, default=4, help="max files per torrent")
+    parser.add_argument("--min-size", type=int, default=1, help="min file size in MB")
+    parser.add_argument(
+        "--max-size", type=int, default=8192, help="max file size in MB"
+    )
+    parser.add_argument("--cross-seed-ratio", type=float, default=0.2)
+    parser.add_argument("--destinations", type=int, default=1)
+    parser.add_argument("--free", type=int, default=100, help="GB to free")
+    parser.add_argument("--min-space", type=int, default=200, help="router GB")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="seconds")
+    parser.add_argument(
+        "--fill-rate", type=float, default=0, help="source MB/s of simulated downloads"
+    )
+    parser.add_argument(
+        "--check-time", type=float, default=1, help="destination check seconds"
+    )
+    parser.add_argument("--no-presync", dest="presync", action="store_false")
+    parser.add_argument("--sleep", type=int, default=2, help="router loop seconds")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=default_workdir())
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger("qbrouter").setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="qbrouter-load-", dir=args.workdir)
+    try:
+        src_root = os.path.join(workdir, "src")
+        dest_roots = [
+            os.path.join(workdir, f"dest{i}") for i in range(args.destinations)
+        ]
+        for root in [src_root] + dest_roots:
+            os.makedirs(root)
+
+        torrents = populate(args, src_root, dest_roots)
+        src = FakeQBittorrent(
+            src_root,
+            src_root,
+            0,
+            args.latency,
+            args.jitter,
+            int(args.fill_rate * 1048576),
+        )
+        for torrent, metainfo in torrents:
+            src.add(torrent, metainfo)
+        # Start free_space_on_disk --free GB below the router's threshold
+        src.disk_size = src.used_space() + (args.min_space - args.free) * GB
+        dests = [
+            FakeQBittorrent(
+                src_root,
+                root,
+                1 << 50,
+                args.latency,
+                args.jitter,
+                check_time=args.check_time,
+            )
+            for root in dest_roots
+        ]
+
+        conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.get_context("fork").Process(
+            target=serve, args=([src] + dests, child_conn), daemon=True
+        )
+        server.start()
+        src_url, *dest_urls = conn.recv()
+
+        transfer_backend = "rsync" if shutil.which("rsync") else "native"
+        sys.argv = [
+            "qbrouter",
+            f"--src={src_root}",
+            f"--dest={','.join(dest_roots)}",
+            f"--src-url={src_url}",
+            f"--dest-url={','.join(dest_urls)}",
+            f"--min-space={args.min_space}",
+            f"--sleep={args.sleep}",
+            f"--state-db={os.path.join(workdir, 'state.db')}",
+            f"--transfer-backend={transfer_backend}",
+            "--dest-reserve=0",
+            *router_args,
+        ]
+        config = get_config()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        freed_at, src_stats, dest_stats = asyncio.run(
+            drive(
+                config,
+                src_url,
+                dest_urls,
+                args.min_space * GB,
+                args.timeout,
+            )
+        )
+        conn.send("stop")
+        server.join(10)
+
+        report(args, freed_at, pass_count("tag"), src_stats, dest_stats, rss_before)
+        return 0 if freed_at is not None else 1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
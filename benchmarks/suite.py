@@ -0,0 +1,144 @@
+"""Benchmarks of the router's hot functions.
+
+Each benchmark is a setup function taking the scale parameter and a scratch
+directory; it builds its data and returns the callable that is timed.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+from benchmarks.generators import (
+    SAVE_PATH,
+    build_dir_tree,
+    build_file_tree,
+    synthetic_torrents,
+)
+from qbrouter.tasks.qb import has_synced_tag, torrent_file_path
+from qbrouter.tasks.rsync import collapse_paths
+from qbrouter.utils.file import group_by_shared, group_hardlinked
+from qbrouter.utils.planner import plan_eviction
+from qbrouter.utils.watcher import get_directories_recursive
+
+# name -> (setup, {scale: [params]})
+BENCHMARKS = {}
+
+SCALES = {
+    "small": {"torrents": [1000, 10000], "tree": [1000], "dirs": [10000]},
+    "full": {"torrents": [1000, 10000, 100000], "tree": [10000], "dirs": [100000]},
+}
+
+
+def benchmark(name: str, params: str):
+    def register(setup):
+        BENCHMARKS[name] = (setup, params)
+        return setup
+
+    return register
+
+
+@benchmark("torrent_file_path", "torrents")
+def bench_torrent_file_path(count: int, workdir: Path):
+    torrents, files = synthetic_torrents(count)
+    pairs = [(t, f) for t in torrents for f in files[t["hash"]]]
+    dest, save_path = Path("/cold"), Path(SAVE_PATH)
+
+    def run():
+        for torrent, file in pairs:
+            torrent_file_path(torrent, file, dest, save_path)
+
+    return run
+
+
+@benchmark("has_synced_tag", "torrents")
+def bench_has_synced_tag(count: int, workdir: Path):
+    torrents, _ = synthetic_torrents(count)
+    # The function logs every call at DEBUG, measure it as deployed (INFO)
+    logging.getLogger("qbrouter").setLevel(logging.INFO)
+
+    def run():
+        return [torrent for torrent in torrents if has_synced_tag(torrent)]
+
+    return run
+
+
+@benchmark("group_by_shared", "torrents")
+def bench_group_by_shared(count: int, workdir: Path):
+    torrents, files = synthetic_torrents(count)
+    # Cross-seeds share the inode keys of their original
+    keys = {}
+    for torrent in torrents:
+        origin = torrent["cross_seed_of"] or torrent["hash"]
+        keys[torrent["hash"]] = [
+            (origin, i) for i in range(len(files[torrent["hash"]]))
+        ]
+
+    def run():
+        return group_by_shared(keys)
+
+    return run
+
+
+@benchmark("group_hardlinked", "tree")
+def bench_group_hardlinked(count: int, workdir: Path):
+    torrents, files = synthetic_torrents(count)
+    paths = build_file_tree(workdir, torrents, files)
+
+    def run():
+        return group_hardlinked(paths)
+
+    return run
+
+
+@benchmark("plan_eviction", "torrents")
+def bench_plan_eviction(count: int, workdir: Path):
+    torrents, _ = synthetic_torrents(count)
+    groups = [
+        {
+            "name": torrent["name"],
+            "popularity": torrent["popularity"],
+            "size": torrent["size"],
+            "torrents": [torrent],
+        }
+        for torrent in torrents
+        if not torrent["cross_seed_of"]
+    ]
+    bytes_needed = sum(group["size"] for group in groups) // 20
+
+    def run():
+        return plan_eviction(groups, bytes_needed)
+
+    return run
+
+
+@benchmark("collapse_paths", "torrents")
+def bench_collapse_paths(count: int, workdir: Path):
+    torrents, files = synthetic_torrents(count, cross_seed_ratio=0)
+    root = workdir / "src"
+    # Only the torrent roots exist, so every changed file is kept by lexists
+    changed = []
+    for torrent in torrents[: max(1, count // 10)]:
+        (root / torrent["name"]).mkdir(parents=True, exist_ok=True)
+        changed.append(str(root / torrent["name"]))
+        changed.extend(str(root / file["name"]) for file in files[torrent["hash"]][:20])
+
+    def run():
+        return collapse_paths(changed, root)
+
+    return run
+
+
+@benchmark("get_directories_recursive", "dirs")
+def bench_get_directories_recursive(count: int, workdir: Path):
+    build_dir_tree(workdir / "tree", count)
+
+    def run():
+        for _ in get_directories_recursive(workdir / "tree"):
+            pass
+
+    return run
+
+
+def default_workdir() -> str:
+    # Prefer tmpfs so the trees measure the code, not the disk
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
@@ -5,7 +5,7 @@ import os
 import sys
 from pathlib import Path
 
-from qbrouter.utils.parser import EnvDefault
+from qbrouter.utils.parser import EnvDefault, parse_destinations
 
 from qbrouter.logger import (
     logger,
@@ -32,7 +32,7 @@ def get_parser():
         "--dest",
         action=EnvDefault,
         envvar="DEST_PATH",
-        help="qBittorrent server address",
+        help="destination paths, comma-separated for several destinations",
         required=True,
     )
 
@@ -66,7 +66,7 @@ def get_parser():
         "--dest-url",
         action=EnvDefault,
         envvar="QB_DEST_URL",
-        help="qBittorrent destination url",
+        help="qBittorrent destination urls, one per destination path",
         required=True,
     )
 
@@ -86,6 +86,15 @@ def get_parser():
         required=False,
     )
 
+    parser.add_argument(
+        "--dest-target",
+        action=EnvDefault,
+        envvar="DEST_TARGET",
+        help="Remote rsync targets of the destinations, rsync://host/module/path "
+        "for an rsync daemon or [user@]host:path over SSH",
+        required=False,
+    )
+
     parser.add_argument(
         "--min-space",
         action=EnvDefault,
@@ -118,6 +127,238 @@ def get_parser():
         required=False,
     )
 
+    parser.add_argument(
+        "--verify-threads",
+        action=EnvDefault,
+        envvar="VERIFY_THREADS",
+        help="threads used to verify destination files",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--verify-concurrency",
+        action=EnvDefault,
+        envvar="VERIFY_CONCURRENCY",
+        help="torrents verified concurrently",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--incremental-max-files",
+        action=EnvDefault,
+        envvar="INCREMENTAL_MAX_FILES",
+        help="changed paths above which a full rsync is run instead",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--incremental-max-size",
+        action=EnvDefault,
+        envvar="INCREMENTAL_MAX_SIZE",
+        help="changed GB above which a full rsync is run instead",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--full-sync-interval",
+        action=EnvDefault,
+        envvar="FULL_SYNC_INTERVAL",
+        help="seconds between full reconcile rsyncs",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--rsync-workers",
+        action=EnvDefault,
+        envvar="RSYNC_WORKERS",
+        help="number of concurrent rsync processes",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--move-concurrency",
+        action=EnvDefault,
+        envvar="MOVE_CONCURRENCY",
+        help="torrents moved to the destination concurrently",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        action=EnvDefault,
+        envvar="METRICS_PORT",
+        help="port of the metrics endpoint, disabled if unset",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metrics-host",
+        action=EnvDefault,
+        envvar="METRICS_HOST",
+        help="address the metrics endpoint listens on",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--api-concurrency",
+        action=EnvDefault,
+        envvar="QB_API_CONCURRENCY",
+        help="concurrent connections per qBittorrent instance",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--state-db",
+        action=EnvDefault,
+        envvar="STATE_DB",
+        help="path of the SQLite state database, :memory: to keep no state",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--initial-sync",
+        action=EnvDefault,
+        envvar="INITIAL_SYNC",
+        help="initial sync mode: stored, manifest or full",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--transfer-backend",
+        action=EnvDefault,
+        envvar="TRANSFER_BACKEND",
+        help="file transfer backend: rsync or native",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--copy-threads",
+        action=EnvDefault,
+        envvar="COPY_THREADS",
+        help="threads used by the native transfer backend",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--copy-split-size",
+        action=EnvDefault,
+        envvar="COPY_SPLIT_SIZE",
+        help="size in MB above which the native backend copies a file in parallel ranges",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--bwlimit-ceiling",
+        action=EnvDefault,
+        envvar="BWLIMIT_CEILING",
+        help="transfer rate in MB/s when the source disk is idle, unlimited if unset",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--bwlimit-floor",
+        action=EnvDefault,
+        envvar="BWLIMIT_FLOOR",
+        help="transfer rate in MB/s under full seeding load",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--verify-mode",
+        action=EnvDefault,
+        envvar="VERIFY_MODE",
+        help="how synced torrents are verified: size or pieces",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--hash-workers",
+        action=EnvDefault,
+        envvar="HASH_WORKERS",
+        help="processes hashing destination data in pieces verify mode",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--skip-checking",
+        action=EnvDefault,
+        envvar="SKIP_CHECKING",
+        help="add moved torrents without a recheck: auto (after piece verification), always or never",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--dest-reserve",
+        action=EnvDefault,
+        envvar="DEST_RESERVE",
+        help="free space in GB to keep on each destination when placing torrents",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--batch-window",
+        action=EnvDefault,
+        envvar="BATCH_WINDOW",
+        help="milliseconds to gather tag, stop, start, delete and info calls into one multi-hash request",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--diagnostics-dir",
+        action=EnvDefault,
+        envvar="DIAGNOSTICS_DIR",
+        help="directory diagnostics reports and profiles are written to",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--profile-seconds",
+        action=EnvDefault,
+        envvar="PROFILE_SECONDS",
+        help="seconds the profiler runs once toggled with SIGUSR2 or /debug/profile",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--debug-endpoints",
+        action=EnvDefault,
+        envvar="DEBUG_ENDPOINTS",
+        help="serve /debug/tasks and /debug/profile on the metrics endpoint (true)",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--high-space",
+        action=EnvDefault,
+        envvar="HIGH_SPACE",
+        help="free space in GB to evict up to once eviction started",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--history-interval",
+        action=EnvDefault,
+        envvar="HISTORY_INTERVAL",
+        help="minutes of upload history per bucket",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--history-days",
+        action=EnvDefault,
+        envvar="HISTORY_DAYS",
+        help="days of upload history kept per torrent",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--upload-window",
+        action=EnvDefault,
+        envvar="UPLOAD_WINDOW",
+        help="hours of upload history eviction scores torrents on",
+        required=False,
+    )
+
     return parser
 
 
@@ -126,12 +367,50 @@ def get_config():
     config = parser.parse_args()
     config.run = True
     config.src = Path(config.src)
-    config.dest = Path(config.dest)
+    try:
+        config.destinations = parse_destinations(config)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
     config.min_space = int(config.min_space or 50)
     config.min_seeding_time = int(config.min_seeding_time or 3600)
     config.dry_run = getattr(config, "dry_run", "false") == "true"
     config.force = getattr(config, "force", "false") == "true"
     config.sleep = int(config.sleep or 30)
+    config.verify_threads = int(config.verify_threads or 8)
+    config.verify_concurrency = int(config.verify_concurrency or 16)
+    config.incremental_max_files = int(config.incremental_max_files or 5000)
+    config.incremental_max_size = int(config.incremental_max_size or 500)
+    config.full_sync_interval = int(config.full_sync_interval or 21600)
+    config.rsync_workers = int(config.rsync_workers or 4)
+    config.move_concurrency = int(config.move_concurrency or 4)
+    config.metrics_port = int(config.metrics_port or 0)
+    config.metrics_host = config.metrics_host or "0.0.0.0"
+    config.api_concurrency = int(config.api_concurrency or 8)
+    config.state_db = config.state_db or os.path.join(
+        os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"),
+        "qbrouter",
+        "state.db",
+    )
+    config.initial_sync = config.initial_sync or "stored"
+    config.transfer_backend = config.transfer_backend or "rsync"
+    config.copy_threads = int(config.copy_threads or 16)
+    config.copy_split_size = int(config.copy_split_size or 256)
+    config.bwlimit_ceiling = int(config.bwlimit_ceiling or 0)
+    config.bwlimit_floor = int(config.bwlimit_floor or 10)
+    config.verify_mode = config.verify_mode or "size"
+    config.hash_workers = int(config.hash_workers or os.cpu_count() or 4)
+    config.skip_checking = config.skip_checking or "auto"
+    config.dest_reserve = int(config.dest_reserve or 50)
+    config.batch_window = int(config.batch_window or 50)
+    config.diagnostics_dir = Path(config.diagnostics_dir or "/tmp")
+    config.profile_seconds = int(config.profile_seconds or 30)
+    config.debug_endpoints = getattr(config, "debug_endpoints", "false") == "true"
+    config.high_space = max(
+        int(config.high_space or config.min_space * 1.2), config.min_space
+    )
+    config.history_interval = int(config.history_interval or 60)
+    config.history_days = int(config.history_days or 7)
+    config.upload_window = int(config.upload_window or 24)
 
     return config
 
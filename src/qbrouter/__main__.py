@@ -3,6 +3,8 @@ import signal
 
 from qbrouter import logger, get_config
 from qbrouter.tasks import get_tasks
+from qbrouter.utils.diagnostics import Diagnostics
+from qbrouter.utils.metrics import add_route
 
 
 async def main():
@@ -16,11 +18,23 @@ async def main():
     loop.add_signal_handler(signal.SIGINT, handle_signal)
     loop.add_signal_handler(signal.SIGTERM, handle_signal)
 
+    # SIGUSR1 writes a report of tasks, threads, executors and loop lag,
+    # SIGUSR2 starts or stops the profiler; both can also be served with
+    # metrics, which has no authentication, so only when asked for
+    diagnostics = Diagnostics(config.diagnostics_dir, config.profile_seconds)
+    loop.add_signal_handler(signal.SIGUSR1, diagnostics.dump)
+    loop.add_signal_handler(signal.SIGUSR2, diagnostics.toggle_profiler)
+    if config.debug_endpoints:
+        add_route("/debug/tasks", diagnostics.report)
+        add_route("/debug/profile", diagnostics.profile_route)
+
     logger.info(
         "Starting qb-router in dry-run mode" if config.dry_run else "Starting qb-router"
     )
 
-    await asyncio.gather(*[task.run(config) for task in get_tasks()])
+    await asyncio.gather(
+        diagnostics.monitor(config), *[task.run(config) for task in get_tasks()]
+    )
 
 
 if __name__ == "__main__":
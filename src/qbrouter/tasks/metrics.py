@@ -0,0 +1,20 @@
+import asyncio
+
+from qbrouter import get_task_logger
+from qbrouter.utils.metrics import serve
+
+# Create a task-specific logger
+logger = get_task_logger("metrics")
+
+
+async def run(config):
+    if not config.metrics_port:
+        return
+
+    server = await serve(config.metrics_host, config.metrics_port, logger)
+
+    async with server:
+        while config.run:
+            await asyncio.sleep(1)
+
+    logger.info("Stopping metrics endpoint")
@@ -1,210 +1,640 @@
 import asyncio
+import hashlib
+import json
 import logging
+import math
 import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-from qbittorrentapi import (
-    TorrentInfoList,
-    Client,
-    TorrentFilesList,
-    TorrentFile,
-    TorrentDictionary,
-)
-
 from qbrouter import get_task_logger
 from qbrouter.utils.wait import until
-from qbrouter.utils.file import are_hardlinked
+from qbrouter.utils.batch import RequestBatcher
+from qbrouter.utils.bus import PRIORITY, SERVER_STATE, SYNCED, get_bus
+from qbrouter.utils.diagnostics import register_executor
+from qbrouter.utils.file import check_sizes, group_hardlinked
+from qbrouter.utils.forecast import FillForecast
+from qbrouter.utils.history import UploadHistory
+from qbrouter.utils.maindata import TorrentState
+from qbrouter.utils.metrics import API_LATENCY, PASS_DURATION, PENDING_MOVES
+from qbrouter.utils.pieces import parse_torrent, plan_units, verify_pieces
+from qbrouter.utils.placement import Destination, open_placement
+from qbrouter.utils.planner import eviction_order, plan_eviction
+from qbrouter.utils.qbclient import AsyncClient, is_checking, is_stopped
+from qbrouter.utils.store import open_store, torrent_layout
 
 # Create a task-specific logger
 logger = get_task_logger("qb")
 
 SYNCED_TAG = "synced"
 
+# Seconds after which a failed verification is repeated even without new syncs
+VERIFY_TTL = 3600
 
-def has_synced_tag(torrent):
-    logger.debug(f"Torrent {torrent.name} tags: {torrent['tags']}")
-    return SYNCED_TAG in map(str.strip, torrent["tags"].split(","))
+# Time allowed for the destination to check a moved torrent: a fixed part plus
+# the time to read it at CHECK_RATE bytes per second
+CHECK_TIMEOUT = 300
+CHECK_RATE = 52428800
 
+# Polls a destination torrent must stay incomplete and not checking to count
+# as incomplete
+SETTLE_POLLS = 5
 
-async def delete_torrent(client: Client, torrent_hash: str):
-    return await asyncio.to_thread(client.torrents.delete, torrent_hash)
+# Seconds between two server_state readings shared with the transfer throttle
+LOAD_INTERVAL = 5
 
+# Destination states before a torrent starts checking
+PREPARING_STATES = {"allocating", "moving", "metaDL", "forcedMetaDL", "unknown"}
 
-async def fetch_torrent(client: Client, torrent_hash: str) -> TorrentDictionary:
-    return next(
-        iter(
-            await asyncio.to_thread(client.torrents.info, torrent_hashes=[torrent_hash])
-            or []
-        ),
-        None,
-    )
 
+def has_synced_tag(torrent):
+    logger.debug(f"Torrent {torrent['name']} tags: {torrent['tags']}")
+    return SYNCED_TAG in map(str.strip, torrent["tags"].split(","))
 
-async def fetch_completed_torrents(client: Client) -> TorrentInfoList:
-    return await asyncio.to_thread(client.torrents.info.completed)
 
+async def fetch_completed_torrents(state: TorrentState) -> list[dict]:
+    return (await state.update()).completed()
 
-async def fetch_synced_torrents(client: Client) -> TorrentInfoList:
-    return await asyncio.to_thread(
-        client.torrents.info.completed, tags=SYNCED_TAG, sort="size", reverse=False
-    )
+
+async def fetch_synced_torrents(state: TorrentState) -> list[dict]:
+    return (await state.update()).tagged(SYNCED_TAG)
 
 
-async def fetch_save_path(client: Client) -> Path:
-    return Path(await asyncio.to_thread(client.app_default_save_path))
+async def fetch_save_path(client: AsyncClient) -> Path:
+    with API_LATENCY.time(endpoint="app/defaultSavePath"):
+        return Path(await client.app_default_save_path())
 
 
-async def fetch_maindata(client: Client):
-    return await asyncio.to_thread(client.sync.maindata)
+async def fetch_maindata(client: AsyncClient):
+    with API_LATENCY.time(endpoint="sync/maindata"):
+        return await client.sync_maindata()
 
 
-async def fetch_free_space_on_disk(client: Client):
-    return (await asyncio.to_thread(client.sync.maindata))["server_state"][
-        "free_space_on_disk"
-    ]
+async def fetch_free_space_on_disk(state: TorrentState):
+    return (await state.update()).free_space_on_disk
 
 
-async def fetch_free_space_on_disk_in_gb(client: Client):
-    return await fetch_free_space_on_disk(client) / 1073741824
+async def fetch_free_space_on_disk_in_gb(state: TorrentState):
+    return await fetch_free_space_on_disk(state) / 1073741824
 
 
-async def fetch_torrent_files(client: Client, torrent_hash: str) -> TorrentFilesList:
-    return await asyncio.to_thread(client.torrents.files, torrent_hash)
+async def fetch_torrent_files(state: TorrentState, torrent_hash: str) -> list[dict]:
+    return await state.files(torrent_hash)
+
+
+def torrent_relative_path(torrent: dict, file: dict, save_path: Path) -> str:
+    content_file_path = os.path.join(torrent["save_path"], file["name"])
+    return content_file_path[len(str(save_path)) + 1 :]
 
 
 def torrent_file_path(
-    torrent: TorrentDictionary, file: TorrentFile, dest_path: Path, save_path: Path
+    torrent: dict, file: dict, dest_path: Path, save_path: Path
 ) -> Path:
-    content_file_path = os.path.join(torrent["save_path"], file["name"])
-    relative_content_path = content_file_path[len(str(save_path)) + 1 :]
-    return Path(os.path.join(dest_path, relative_content_path))
+    return Path(
+        os.path.join(dest_path, torrent_relative_path(torrent, file, save_path))
+    )
 
 
 async def are_torrent_files_synced(
-    client: Client, torrent, dest_path: Path, save_path: Path, logger: logging.Logger
+    state: TorrentState,
+    torrent,
+    dest_path: Path,
+    save_path: Path,
+    logger: logging.Logger,
+    executor: Executor | None = None,
+    observed: list | None = None,
 ) -> bool:
-    for file in await fetch_torrent_files(client, torrent["hash"]):
+    # Group the expected file sizes by directory so each one is listed once
+    directories = {}
+    names = {}
+    for file in await fetch_torrent_files(state, torrent["hash"]):
         dest_torrent_file_path = torrent_file_path(torrent, file, dest_path, save_path)
+        directories.setdefault(dest_torrent_file_path.parent, {})[
+            dest_torrent_file_path.name
+        ] = file["size"]
+        names[dest_torrent_file_path] = file["name"]
+
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, check_sizes, directory, sizes)
+            for directory, sizes in directories.items()
+        ]
+    )
 
-        if not dest_torrent_file_path.exists():
-            logger.debug(f"Torrent missing dest file: {dest_torrent_file_path}")
-            return False
-
-        # Check if file sizes match
-        try:
-            dest_file_size = dest_torrent_file_path.stat().st_size
-            expected_size = file["size"]
-
-            if dest_file_size != expected_size:
-                logger.debug(
-                    f"File size mismatch for {dest_torrent_file_path}: "
-                    f"expected {expected_size}, got {dest_file_size}"
-                )
-                return False
-        except OSError as e:
-            logger.debug(f"Failed to get file size for {dest_torrent_file_path}: {e}")
-            return False
-
-    return True
+    synced = True
+    for directory, (mismatch, dest_files) in zip(directories, results):
+        if observed is not None:
+            observed.extend(
+                (names[directory / name], size, mtime_ns)
+                for name, (size, mtime_ns) in dest_files.items()
+            )
+        if mismatch and synced:
+            logger.debug(f"Torrent missing or mismatched dest file: {mismatch}")
+            synced = False
 
-
-def are_hardlinked_files(files, other_files):
-    return all(
-        any(are_hardlinked(file, other_file) for other_file in other_files)
-        for file in files
-    )
+    return synced
 
 
 async def run(config):
-    if config.src_url == config.dest_url:
+    if any(config.src_url == destination.url for destination in config.destinations):
         logger.error("Source and destination URLs are the same")
         return
 
-    src_client = Client(
-        host=config.src_url, username=config.src_username, password=config.src_password
+    src_client = AsyncClient(
+        host=config.src_url,
+        username=config.src_username,
+        password=config.src_password,
+        limit_per_host=config.api_concurrency,
+    )
+    # Tag, stop, start, delete and info calls of concurrent moves and tagging
+    # are sent as multi-hash requests
+    src_batch = RequestBatcher(src_client, config.batch_window / 1000)
+    placement = open_placement(config)
+    store = open_store(config.state_db)
+    src_state = TorrentState(src_client, store)
+    verify_executor = ThreadPoolExecutor(
+        max_workers=config.verify_threads, thread_name_prefix="verify"
+    )
+    verify_semaphore = asyncio.Semaphore(config.verify_concurrency)
+    hash_executor = (
+        ProcessPoolExecutor(max_workers=config.hash_workers)
+        if config.verify_mode == "pieces"
+        else None
+    )
+    register_executor("verify", verify_executor)
+    if hash_executor:
+        register_executor("hash", hash_executor)
+    move_semaphore = asyncio.Semaphore(config.move_concurrency)
+    forecast = FillForecast(
+        config.min_space * 1073741824,
+        config.high_space * 1073741824,
+        config.sleep,
+        config.move_concurrency,
     )
-    dest_client = Client(
-        host=config.dest_url,
-        username=config.dest_username,
-        password=config.dest_password,
+    history = UploadHistory(
+        config.history_interval * 60,
+        config.history_days * 1440 // config.history_interval,
     )
+    history.load(await asyncio.to_thread(store.upload_history))
+    upload_window = config.upload_window * 60 // config.history_interval
+    bus = get_bus()
+    synced_events = bus.subscribe(SYNCED)
+    # Source files the rsync task reported as synced, relative path -> size
+    synced_files = {}
+    # When each source file was last reported synced, relative path -> time
+    synced_at = {}
+    started_at = time.time()
+    # Unsynced torrents already sent to the rsync task as eviction candidates
+    prioritized = set()
+
+    async def destination_of(torrent, save_path) -> Destination | None:
+        """Return the destination the content of a torrent is placed on"""
+        files = await fetch_torrent_files(src_state, torrent["hash"])
+        if not files:
+            return None
+        entry = Path(torrent_relative_path(torrent, files[0], save_path)).parts[0]
+        return await placement.destination_of(entry)
+
+    async def torrent_synced_at(torrent, save_path) -> float:
+        """Return when files of a torrent were last reported synced"""
+        files = await fetch_torrent_files(src_state, torrent["hash"])
+        return max(
+            (
+                synced_at.get(torrent_relative_path(torrent, file, save_path), 0)
+                for file in files
+            ),
+            default=0,
+        )
+
+    async def is_torrent_synced(torrent, save_path, last_rsync_at):
+        destination = await destination_of(torrent, save_path)
+        if destination is None:
+            # Not placed on a destination yet, so not synced anywhere
+            return False
+
+        layout = torrent_layout(torrent)
+        verification = store.verification(torrent["hash"])
+        if (
+            verification
+            and verification.layout == layout
+            and time.time() - verification.verified_at < VERIFY_TTL
+        ):
+            # Syncs before this process started were not reported by path
+            changed_at = (
+                last_rsync_at
+                if verification.verified_at < started_at
+                else await torrent_synced_at(torrent, save_path)
+            )
+            if verification.verified_at >= changed_at:
+                # None of its files was synced since the last check
+                return verification.synced
+
+        observed = []
+        async with verify_semaphore:
+            synced = await are_torrent_files_synced(
+                src_state,
+                torrent,
+                destination.path,
+                save_path,
+                logger,
+                verify_executor,
+                observed,
+            )
+        if synced and hash_executor:
+            synced = await are_torrent_pieces_synced(
+                torrent, destination.path, save_path, observed
+            )
+        await asyncio.to_thread(store.save_verification, torrent, layout, synced)
+        return synced
+
+    async def are_torrent_pieces_synced(torrent, dest_path, save_path, observed):
+        """Hash the destination files against the piece hashes of the torrent,
+        resuming from the last checkpoint if the files did not change"""
+        torrent_hash = torrent["hash"]
+        with API_LATENCY.time(endpoint="torrents/export"):
+            data = await src_client.torrents_export(torrent_hash)
+        files = sorted(
+            await fetch_torrent_files(src_state, torrent_hash),
+            key=lambda f: f.get("index", 0),
+        )
+        paths = [
+            str(torrent_file_path(torrent, file, dest_path, save_path))
+            for file in files
+        ]
+        try:
+            units = await asyncio.to_thread(
+                lambda: plan_units(parse_torrent(data), paths)
+            )
+        except (ValueError, KeyError) as e:
+            logger.error(f"Cannot read the pieces of {torrent['name']}: {e}")
+            return False
+
+        fingerprint = hashlib.sha1(
+            json.dumps(sorted(observed)).encode(), usedforsecurity=False
+        ).hexdigest()
+        done = await asyncio.to_thread(
+            store.piece_checkpoint, torrent_hash, fingerprint
+        )
+        if done:
+            logger.info(
+                f"Resuming piece verification of {torrent['name']} at "
+                f"{len(done)}/{len(units)}"
+            )
+
+        synced = await verify_pieces(
+            units,
+            hash_executor,
+            done,
+            lambda done: store.save_piece_checkpoint(torrent_hash, fingerprint, done),
+        )
+        if synced:
+            await asyncio.to_thread(store.clear_piece_checkpoint, torrent_hash)
+        else:
+            logger.warning(f"Destination pieces of {torrent['name']} do not match")
+        return synced
 
     async def tag_synced_torrents():
         save_path = await fetch_save_path(src_client)
-        torrents = [
+        candidates = [
             torrent
-            for torrent in await fetch_completed_torrents(src_client)
+            for torrent in await fetch_completed_torrents(src_state)
             if not has_synced_tag(torrent)
-            and await are_torrent_files_synced(
-                src_client, torrent, config.dest, save_path, logger
-            )
         ]
+        last_rsync_at = store.get_meta("last_rsync_at", 0)
+        synced = await asyncio.gather(
+            *[
+                is_torrent_synced(torrent, save_path, last_rsync_at)
+                for torrent in candidates
+            ]
+        )
+        torrents = [torrent for torrent, ok in zip(candidates, synced) if ok]
         if torrents:
-            for torrent in torrents:
-                logger.info(f"Tagging torrent as synced: {torrent['name']}")
-                if not config.dry_run:
-                    torrent.addTags(SYNCED_TAG)
+            await tag_torrents(torrents)
         else:
             logger.info("No torrents to tag as synced")
 
-    async def move_torrent_to_cold(torrent):
-        await asyncio.to_thread(torrent.stop)
+    async def tag_torrents(torrents):
+        for torrent in torrents:
+            logger.info(f"Tagging torrent as synced: {torrent['name']}")
+        if not config.dry_run:
+            await asyncio.gather(
+                *[
+                    src_batch.add_tags(torrent["hash"], SYNCED_TAG)
+                    for torrent in torrents
+                ]
+            )
+            await asyncio.to_thread(
+                store.mark_tagged, [torrent["hash"] for torrent in torrents]
+            )
+
+    async def tag_reported_torrents():
+        """Tag the torrents whose files were all reported synced by rsync"""
+        save_path = await fetch_save_path(src_client)
+        torrents = []
+        # The first report can come before the mirror was ever updated
+        for torrent in await fetch_completed_torrents(src_state):
+            if has_synced_tag(torrent):
+                continue
+            files = await fetch_torrent_files(src_state, torrent["hash"])
+            if files and all(
+                synced_files.get(torrent_relative_path(torrent, file, save_path))
+                == file["size"]
+                for file in files
+            ):
+                torrents.append(torrent)
+
+        if hash_executor:
+            # Sizes are not enough in pieces mode, verify before tagging
+            verified = await asyncio.gather(
+                *[
+                    is_torrent_synced(torrent, save_path, math.inf)
+                    for torrent in torrents
+                ]
+            )
+            torrents = [torrent for torrent, ok in zip(torrents, verified) if ok]
+        else:
+            for torrent in torrents:
+                await asyncio.to_thread(
+                    store.save_verification, torrent, torrent_layout(torrent), True
+                )
+
+        if torrents:
+            await tag_torrents(torrents)
+
+    async def listen_for_synced():
+        """Tag torrents as soon as rsync reports their content synced"""
+        while config.run:
+            try:
+                event = await asyncio.wait_for(synced_events.get(), timeout=5)
+            except asyncio.TimeoutError:
+                continue
+            while True:
+                if event.full:
+                    synced_files.clear()
+                    synced_at.clear()
+                synced_files.update(event.files)
+                synced_at.update(dict.fromkeys(event.files, time.time()))
+                if synced_events.empty():
+                    break
+                event = synced_events.get_nowait()
+
+            try:
+                await tag_reported_torrents()
+            except Exception as e:
+                logger.error(f"Error tagging synced torrents: {e}")
+
+    async def record_upload_history():
+        if history.sample(src_state.torrents.values()):
+            await asyncio.to_thread(store.save_upload_history, *history.dump())
+
+    def score_groups(groups):
+        """Rank groups on their windowed upload rate once all their torrents
+        have history, on popularity until then"""
+        rates = [
+            [
+                history.rate(torrent["hash"], upload_window)
+                for torrent in group["torrents"]
+            ]
+            for group in groups
+        ]
+        if all(None not in group_rates for group_rates in rates):
+            for group, group_rates in zip(groups, rates):
+                group["upload_rate"] = sum(group_rates) / 1048576
+
+    async def prioritize_unsynced(bytes_needed, save_path):
+        """Ask rsync to sync first the unsynced torrents that would be evicted
+        next"""
+        unsynced = [
+            torrent
+            for torrent in src_state.completed()
+            if not has_synced_tag(torrent)
+            and torrent["seeding_time"] >= config.min_seeding_time
+        ]
+        prioritized.intersection_update(torrent["hash"] for torrent in unsynced)
+        groups = [
+            {
+                "name": torrent["name"],
+                "popularity": torrent["popularity"],
+                "size": torrent["size"],
+                "torrents": [torrent],
+            }
+            for torrent in unsynced
+        ]
+        score_groups(groups)
+        selected = await asyncio.to_thread(plan_eviction, groups, bytes_needed)
+
+        paths = []
+        for torrent_group in selected:
+            torrent = torrent_group["torrents"][0]
+            if torrent["hash"] in prioritized:
+                continue
+            prioritized.add(torrent["hash"])
+            paths.extend(
+                torrent_relative_path(torrent, file, save_path)
+                for file in await fetch_torrent_files(src_state, torrent["hash"])
+            )
+
+        if paths:
+            logger.info(
+                f"Prioritizing the sync of {len(paths)} files of unsynced "
+                "eviction candidates"
+            )
+            bus.publish(PRIORITY, paths)
+
+    async def move_torrent_to_cold(torrent, destination: Destination):
+        torrent_hash = torrent["hash"]
+        dest_client = destination.client
+        dest_batch = destination.batch
+
+        await src_batch.stop(torrent_hash)
         await until(
-            lambda d: torrent.state_enum.is_stopped,
-            lambda: asyncio.to_thread(torrent.sync_local),
+            lambda d: d is not None and is_stopped(d),
+            lambda: src_batch.info(torrent_hash),
             30,
         )
 
-        existing_torrent = await fetch_torrent(dest_client, torrent.hash)
+        existing_torrent = await dest_batch.info(torrent_hash)
 
         if existing_torrent:
-            logger.debug(f"Torrent already exists on destination: {torrent.name}")
-            await asyncio.to_thread(existing_torrent.start)
-            await asyncio.to_thread(torrent.delete, delete_files=True)
-            return
-
-        result = await asyncio.to_thread(
-            dest_client.torrents.add,
-            torrent_files=await asyncio.to_thread(torrent.export),
-            save_path=torrent.save_path,
-            category=torrent.category,
-            tags=torrent.tags,
-            use_auto_torrent_management=torrent.auto_tmm,
+            logger.debug(f"Torrent already exists on destination: {torrent['name']}")
+            # It may be left from a move whose destination check timed out
+            if (
+                is_checking(existing_torrent)
+                or existing_torrent["state"] in PREPARING_STATES
+                or existing_torrent.get("progress", 0) < 1
+            ):
+                logger.warning(
+                    f"Torrent {torrent['name']} is not complete on the destination "
+                    "yet, keeping the source"
+                )
+                await src_batch.start(torrent_hash)
+                return "existing incomplete"
+            await dest_batch.start(torrent_hash)
+            await src_batch.delete(torrent_hash, delete_files=True)
+            return "existing"
+
+        skip_checking = can_skip_checking(torrent)
+        result = await dest_client.torrents_add(
+            torrent_files=await src_client.torrents_export(torrent_hash),
+            save_path=torrent["save_path"],
+            category=torrent["category"],
+            tags=torrent["tags"],
+            use_auto_torrent_management=torrent["auto_tmm"],
+            # Hold the torrent until it is confirmed complete on the destination
+            **(
+                {"skip_checking": True, "stopped": True, "paused": True}
+                if skip_checking
+                else {}
+            ),
         )
 
         if result != "Ok.":
-            logger.error(f"Failed to add torrent {torrent.name}: {result}")
-            await asyncio.to_thread(torrent.start)
-            return
-
-        dest_torrent = await until(
-            lambda d: d is not None,
-            lambda: fetch_torrent(dest_client, torrent.hash),
-            20,
+            logger.error(f"Failed to add torrent {torrent['name']}: {result}")
+            await src_batch.start(torrent_hash)
+            return "add failed"
+
+        try:
+            complete = await wait_for_dest_complete(torrent, destination)
+        except TimeoutError:
+            # The destination keeps checking, the next pass looks at it again
+            await src_batch.start(torrent_hash)
+            raise
+
+        if not complete:
+            logger.error(
+                f"Torrent {torrent['name']} is incomplete on the destination, "
+                "keeping the source"
+            )
+            await dest_batch.delete(torrent_hash)
+            await src_batch.start(torrent_hash)
+            return "incomplete"
+
+        if skip_checking:
+            await dest_batch.start(torrent_hash)
+        await src_batch.delete(torrent_hash, delete_files=True)
+        return "handed off" if skip_checking else "moved"
+
+    def can_skip_checking(torrent) -> bool:
+        """Whether the destination data was verified well enough to skip the
+        recheck of the destination instance"""
+        if config.skip_checking == "never":
+            return False
+        if config.skip_checking != "always" and config.verify_mode != "pieces":
+            return False
+        verification = store.verification(torrent["hash"])
+        return bool(
+            verification
+            and verification.synced
+            and verification.layout == torrent_layout(torrent)
         )
 
-        await until(
-            lambda d: not dest_torrent.state_enum.is_uploading,
-            lambda: asyncio.to_thread(dest_torrent.sync_local),
-            300,
+    async def wait_for_dest_complete(torrent, destination: Destination) -> bool:
+        """Follow the destination check of a torrent until it finishes, with a
+        timeout that grows with the torrent size"""
+        torrent_hash = torrent["hash"]
+        timeout = CHECK_TIMEOUT + torrent["size"] / CHECK_RATE
+        deadline = time.monotonic() + timeout
+        reported_at = time.monotonic()
+        incomplete = 0
+
+        while True:
+            dest_torrent = (await destination.state.update()).torrent(torrent_hash)
+            if dest_torrent and not (
+                is_checking(dest_torrent) or dest_torrent["state"] in PREPARING_STATES
+            ):
+                if dest_torrent.get("progress", 0) >= 1:
+                    return True
+                # A new torrent can show as incomplete before its check starts
+                incomplete += 1
+                if incomplete >= SETTLE_POLLS:
+                    return False
+            else:
+                incomplete = 0
+
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Destination check of {torrent['name']} did not finish "
+                    f"within {timeout:.0f}s"
+                )
+            if dest_torrent and time.monotonic() - reported_at >= 60:
+                reported_at = time.monotonic()
+                logger.info(
+                    f"Destination is checking {torrent['name']}: "
+                    f"{dest_torrent.get('progress', 0):.1%}"
+                )
+            await asyncio.sleep(1)
+
+    async def move_torrent_when_ready(
+        torrent, destination: Destination
+    ) -> tuple[str, float]:
+        """Move a torrent once a move slot is free, returning the result and
+        the duration of the move"""
+        PENDING_MOVES.inc()
+        try:
+            async with move_semaphore:
+                if not config.run:
+                    return "cancelled", 0
+                started_at = time.time()
+                result = "cancelled"
+                try:
+                    with destination.busy():
+                        result = await move_torrent_to_cold(torrent, destination)
+                except Exception as e:
+                    result = f"error: {e}"
+                    raise
+                finally:
+                    finished_at = time.time()
+                    await asyncio.to_thread(
+                        store.record_move, torrent, started_at, finished_at, result
+                    )
+                return result, finished_at - started_at
+        finally:
+            PENDING_MOVES.dec()
+
+    async def move_group(torrent_group, destination: Destination):
+        """Move the torrents of a group, whose shared data is freed once they
+        all left the source"""
+        results = await asyncio.gather(
+            *[
+                move_torrent_when_ready(torrent, destination)
+                for torrent in torrent_group["torrents"]
+            ],
+            return_exceptions=True,
         )
-        await asyncio.to_thread(torrent.delete, delete_files=True)
+        for torrent, result in zip(torrent_group["torrents"], results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to move torrent {torrent['name']}: {result}")
+        if all(
+            not isinstance(result, Exception)
+            and result[0] in ("moved", "handed off", "existing")
+            for result in results
+        ):
+            forecast.moved(
+                torrent_group["size"], max(duration for _, duration in results)
+            )
 
     async def maybe_move_to_cold():
+        free_space = await fetch_free_space_on_disk(src_state)
+        forecast.observe(
+            free_space, float(src_state.server_state.get("dl_info_speed") or 0)
+        )
 
-        if config.run and (
-            (await fetch_free_space_on_disk_in_gb(src_client) < config.min_space)
-            or config.force
-        ):
+        if config.run and (forecast.should_evict(free_space) or config.force):
             if config.force:
                 logger.info("Forcing move of all torrents to cold storage...")
             else:
                 logger.info(
-                    f"Low disk space, attempting to move torrents to {config.dest_url}..."
+                    f"Free space {free_space / 1073741824:.1f} GB, forecast "
+                    f"{forecast.forecast(free_space) / 1073741824:.1f} GB at "
+                    f"{forecast.rate / 1048576:.1f} MB/s of downloads, attempting to "
+                    "move torrents to "
+                    f"{', '.join(d.name for d in placement.destinations)}..."
                 )
 
             save_path = await fetch_save_path(src_client)
-            torrents = await fetch_synced_torrents(src_client)
+            torrents = await fetch_synced_torrents(src_state)
 
             torrent_files = {}
             torrent_dict = {}
@@ -212,32 +642,20 @@ async def run(config):
 
             for torrent in torrents:
                 torrent_dict[torrent["hash"]] = torrent
-                torrent_files[torrent["hash"]] = await fetch_torrent_files(
-                    src_client, torrent["hash"]
-                )
-
-            for torrent in torrents:
-                if torrent["hash"] not in torrent_dict:
-                    continue
-
-                torrent_group = [torrent_dict.pop(torrent["hash"])]
-
-                files = [
+                torrent_files[torrent["hash"]] = [
                     torrent_file_path(torrent, f, config.src, save_path)
-                    for f in torrent_files[torrent["hash"]]
+                    for f in await fetch_torrent_files(src_state, torrent["hash"])
                 ]
 
-                for other_torrent in list(torrent_dict.values()):
-                    other_files = [
-                        torrent_file_path(other_torrent, f, config.src, save_path)
-                        for f in torrent_files[other_torrent["hash"]]
-                    ]
+            for hashes in await asyncio.to_thread(group_hardlinked, torrent_files):
+                torrent_group = [torrent_dict[h] for h in hashes]
+                torrent = torrent_group[0]
 
-                    if are_hardlinked_files(files, other_files):
-                        logger.debug(
-                            f"Torrents are hardlinked: {torrent['name']} -> {other_torrent['name']}"
-                        )
-                        torrent_group.append(torrent_dict.pop(other_torrent["hash"]))
+                if len(torrent_group) > 1:
+                    logger.debug(
+                        f"Torrents are hardlinked: {torrent['name']} -> "
+                        f"{', '.join(t['name'] for t in torrent_group[1:])}"
+                    )
 
                 highest_popularity = max(torrent_group, key=lambda t: t["popularity"])[
                     "popularity"
@@ -249,7 +667,7 @@ async def run(config):
 
                 torrent_groups.append(
                     {
-                        "name": torrent.name,
+                        "name": torrent["name"],
                         "popularity": highest_popularity,
                         "size": highest_size,
                         "seeding_time": lowest_seeding_time,
@@ -257,10 +675,8 @@ async def run(config):
                     }
                 )
 
-            for torrent_group in sorted(
-                torrent_groups, key=lambda x: (x["popularity"], -x["size"])
-            ):
-
+            eligible_groups = []
+            for torrent_group in torrent_groups:
                 if (
                     not config.force
                     and torrent_group["seeding_time"] < config.min_seeding_time
@@ -269,23 +685,98 @@ async def run(config):
                         f"Skipping torrent group {torrent_group['name']} due to low seeding time of {torrent_group['seeding_time']}"
                     )
                     continue
+                eligible_groups.append(torrent_group)
+            score_groups(eligible_groups)
 
-                for torrent in torrent_group["torrents"]:
-                    if not config.dry_run:
-                        await move_torrent_to_cold(torrent)
+            if config.force:
+                selected_groups = sorted(eligible_groups, key=eviction_order)
+            else:
+                bytes_needed = forecast.bytes_needed(free_space)
+                selected_groups = await asyncio.to_thread(
+                    plan_eviction, eligible_groups, bytes_needed
+                )
+                logger.info(
+                    f"Freeing {bytes_needed / 1073741824:.1f} GB by moving "
+                    f"{len(selected_groups)} of {len(eligible_groups)} torrent groups"
+                )
+                shortfall = bytes_needed - sum(g["size"] for g in selected_groups)
+                if shortfall > 0:
+                    await prioritize_unsynced(shortfall, save_path)
+
+            # Hardlinked torrents are synced to the same destination, a group
+            # whose torrents ended up apart is not moved
+            moves = []
+            for torrent_group in selected_groups:
+                destinations = {
+                    await destination_of(torrent, save_path)
+                    for torrent in torrent_group["torrents"]
+                }
+                if len(destinations) > 1:
+                    logger.warning(
+                        f"Torrent group {torrent_group['name']} is split over "
+                        f"{len(destinations)} destinations, not moving it"
+                    )
+                    continue
+                destination = destinations.pop()
+                if destination is None:
+                    logger.warning(
+                        f"Torrent group {torrent_group['name']} has no destination"
+                    )
+                    continue
+                moves.append((torrent_group, destination))
+
+            if config.dry_run:
+                for torrent_group, destination in moves:
+                    for torrent in torrent_group["torrents"]:
+                        logger.info(
+                            f"Dry run: moving torrent {torrent['name']} to "
+                            f"{destination.name}"
+                        )
+                return
 
-                if (
-                    not config.run
-                    or await fetch_free_space_on_disk_in_gb(src_client)
-                    > config.min_space
-                ):
-                    break
+            await asyncio.gather(
+                *[
+                    move_group(torrent_group, destination)
+                    for torrent_group, destination in moves
+                ]
+            )
+
+    async def publish_load():
+        """Share the source server_state with the transfer throttle of the
+        rsync task, from the mirror the tag and move passes use"""
+        while config.run:
+            try:
+                await src_state.update()
+            except Exception as e:
+                logger.warning(f"Failed to read the source load: {e}")
+            else:
+                bus.publish(SERVER_STATE, dict(src_state.server_state))
+            await asyncio.sleep(LOAD_INTERVAL)
+
+    listener = asyncio.create_task(listen_for_synced())
+    load = asyncio.create_task(publish_load()) if config.bwlimit_ceiling else None
 
     while config.run:
         try:
-            await tag_synced_torrents()
-            await maybe_move_to_cold()
+            with PASS_DURATION.time(name="tag"):
+                await tag_synced_torrents()
+            await record_upload_history()
+            with PASS_DURATION.time(name="move"):
+                await maybe_move_to_cold()
         except Exception as e:
             logger.error(f"Error: {e}")
         finally:
             await asyncio.sleep(config.sleep)
+
+    await listener
+    if load:
+        await load
+    await asyncio.to_thread(store.save_upload_history, *history.dump())
+    verify_executor.shutdown(wait=False)
+    if hash_executor:
+        hash_executor.shutdown(wait=False, cancel_futures=True)
+    await src_batch.flush()
+    await src_client.close()
+    for destination in placement.destinations:
+        await destination.batch.flush()
+        await destination.client.close()
@@ -1,29 +1,156 @@
 import asyncio
+import logging
 import os
+import shutil
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from qbrouter import get_task_logger
+from qbrouter.utils.bus import PRIORITY, SERVER_STATE, SYNCED, Synced, get_bus
+from qbrouter.utils.copy import copy_files
+from qbrouter.utils.diagnostics import register_executor
 from qbrouter.utils.exec import execute
+from qbrouter.utils.manifest import (
+    changed_paths,
+    diff_manifests,
+    link_files,
+    scan_manifest,
+)
+from qbrouter.utils.metrics import INOTIFY_QUEUE_DEPTH, RSYNC_BYTES, RSYNC_DURATION
+from qbrouter.utils.placement import open_placement
+from qbrouter.utils.progress import RsyncProgress
+from qbrouter.utils.shard import plan_shards, top_level_groups
+from qbrouter.utils.store import open_store
+from qbrouter.utils.throttle import Throttle, ionice_args
+from qbrouter.utils.transport import CHECK_INTERVAL, open_transport
 from qbrouter.utils.watcher import watch_path
 
 # Create a task-specific logger
 logger = get_task_logger("rsync")
 
 
+# rsync exit codes that mean the transfer completed (24: source files vanished)
+RSYNC_OK = (0, 24)
+
+# Shards a sync is split into at least when throttling, so each rsync run
+# starts with a recent bandwidth limit
+THROTTLE_SHARDS = 16
+
+
+def collapse_paths(paths, root) -> list[str]:
+    """Make changed paths relative to root for ``--files-from``.
+
+    Paths that no longer exist are dropped, as are paths inside a directory that
+    is itself in the list since rsync recurses into it. The result is ordered by
+    path components so entries of the same directory are adjacent.
+    """
+    relative = sorted(
+        Path(os.path.relpath(path, root)).parts
+        for path in set(paths)
+        if os.path.lexists(path)
+    )
+
+    collapsed = []
+    for parts in relative:
+        if collapsed and parts[: len(collapsed[-1])] == collapsed[-1]:
+            continue
+        collapsed.append(parts)
+    return [os.path.join(*parts) for parts in collapsed]
+
+
+def split_by_destination(manifest, by_top, placed) -> dict:
+    """Split the paths and manifest of a sync by the destination their
+    top-level entry is placed on, as destination -> (paths, manifest, size)."""
+    parts = {}
+    for top, paths in by_top.items():
+        parts.setdefault(placed[top], [[], {}, 0])[0].extend(paths)
+    for path, meta in manifest.items():
+        part = parts.get(placed.get(Path(path).parts[0]))
+        if part:
+            part[1][path] = meta
+            part[2] += meta.size
+    return {destination: tuple(part) for destination, part in parts.items()}
+
+
 async def run(config):
     queue = asyncio.Queue()
     initial_sync_done = asyncio.Event()
+    last_full_sync = time.monotonic()
+    rsync_semaphore = asyncio.Semaphore(config.rsync_workers)
+    store = open_store(config.state_db)
+    bus = get_bus()
+    priority = bus.subscribe(PRIORITY)
+    # Source server_state published by the qb task when throttling
+    load = bus.subscribe(SERVER_STATE) if config.bwlimit_ceiling else None
+    # Serializes syncs so priority requests go ahead of the next event batch
+    sync_lock = asyncio.Lock()
 
-    if config.src == config.dest:
+    if any(config.src == destination.path for destination in config.destinations):
         logger.error("Source and destination directories are the same")
         return
 
+    placement = open_placement(config)
+
+    try:
+        transports = {
+            destination.path: open_transport(
+                destination.path, destination.target, logger
+            )
+            for destination in config.destinations
+        }
+    except ValueError as e:
+        logger.error(str(e))
+        return
+    remote = any(transport.remote for transport in transports.values())
+    if remote and config.transfer_backend == "native":
+        logger.warning("The native backend cannot copy to remote targets, using rsync")
+
+    copy_executor = ThreadPoolExecutor(
+        max_workers=config.copy_threads, thread_name_prefix="copy"
+    )
+    register_executor("copy", copy_executor)
+
+    throttle = None
+    if config.bwlimit_ceiling:
+        throttle = Throttle(
+            config.bwlimit_floor * 1048576, config.bwlimit_ceiling * 1048576
+        )
+
     src = os.path.join(config.src, "")
+    # rsync processes running, to move them to another I/O class
+    running = set()
+
+    async def execute_rsync(cmd, reason) -> tuple[int, RsyncProgress]:
+        progress = RsyncProgress()
+        started = []
+
+        def on_output(line):
+            progress.feed(line)
+            if progress.due():
+                logger.info(f"Rsync progress ({reason}): {progress.summary()}")
+
+        def on_start(process):
+            started.append(process)
+            running.add(process)
 
-    async def rsync(reason="sync", files=None):
-        logger.info(f"Rsyncing {src} to {config.dest} ({reason})")
+        try:
+            with RSYNC_DURATION.time():
+                returncode = await execute(
+                    cmd, logger, on_output, logging.DEBUG, on_start
+                )
+        finally:
+            running.difference_update(started)
+        RSYNC_BYTES.inc(progress.sent_bytes)
+        logger.info(f"Rsync finished ({reason}): {progress.summary()}")
+        return returncode, progress
+
+    async def rsync(reason="sync", files=None, dest=None) -> tuple[int, RsyncProgress]:
+        transport = transports[dest or config.destinations[0].path]
+        dest = transport.target
+        await transport.connect()
+        logger.info(f"Rsyncing {src} to {dest} ({reason})")
 
         cmd = [
             "rsync",
@@ -32,8 +159,7 @@ async def run(config):
             "--whole-file",
             "--inplace",
             "--partial",
-            "--verbose",
-            "--progress",
+            "--info=progress2,stats1",
             "--one-file-system",
             "--recursive",
             "--perms",
@@ -44,21 +170,15 @@ async def run(config):
             "--acls",
             "--xattrs",
             "--itemize-changes",
+            *transport.rsync_args(),
         ]
 
-        if files:
-
-            # Filter out out files that do not exist and make them relative to src
-            files = [
-                os.path.relpath(file, config.src)
-                for file in files
-                if os.path.exists(file) and not os.path.isdir(file)
-            ]
-
-            if not files:
-                logger.info("No files to sync, skipping rsync")
-                return
+        if throttle:
+            cmd.extend(throttle.rsync_args())
+            if shutil.which("ionice"):
+                cmd = ionice_args(throttle.io_class) + cmd
 
+        if files:
             # Create temporary file with list of files to sync
             with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
                 for file_path in files:
@@ -66,10 +186,10 @@ async def run(config):
                 files_from = f.name
 
             cmd.extend(["--files-from", files_from, "--relative"])
-            cmd.extend([src, config.dest])
+            cmd.extend([src, dest])
 
             try:
-                await execute(cmd, logger)
+                return await execute_rsync(cmd, reason)
             except Exception:
                 # Re-raise the exception after cleanup
                 raise
@@ -85,8 +205,208 @@ async def run(config):
                         f"Failed to cleanup temporary file {files_from}: {e}"
                     )
         else:
-            cmd.extend([src, config.dest])
-            await execute(cmd, logger)
+            cmd.extend([src, dest])
+            return await execute_rsync(cmd, reason)
+
+    async def native_copy(reason="sync", files=None, manifest=None, dest=None) -> bool:
+        """Copy changed files in-process instead of spawning rsync"""
+        dest = dest or config.destinations[0].path
+        logger.info(f"Copying {src} to {dest} ({reason})")
+        if manifest is None:
+            manifest = await asyncio.to_thread(scan_manifest, config.src, files)
+
+        with RSYNC_DURATION.time():
+            stats = await copy_files(
+                config.src,
+                dest,
+                manifest,
+                copy_executor,
+                config.copy_threads,
+                config.copy_split_size * 1048576,
+                logger,
+                throttle,
+            )
+        RSYNC_BYTES.inc(stats.bytes)
+
+        logger.info(
+            f"Copied {stats.copied} files ({stats.bytes} bytes), linked "
+            f"{stats.linked}, skipped {stats.skipped} unchanged, {stats.failed} failed"
+        )
+        return not stats.failed
+
+    async def sharded_rsync(
+        reason="sync", files=None, manifest=None, dest=None
+    ) -> bool:
+        """Run rsync in parallel shards split by top-level directory"""
+        if config.transfer_backend == "native" and not remote:
+            return await native_copy(reason, files, manifest, dest)
+
+        if config.rsync_workers <= 1 and not throttle:
+            returncode, _ = await rsync(reason, files, dest)
+            return returncode in RSYNC_OK
+
+        paths = files if files else await asyncio.to_thread(os.listdir, config.src)
+        if manifest is None:
+            manifest = await asyncio.to_thread(scan_manifest, config.src, paths)
+        # The bandwidth limit of a running rsync cannot change
+        count = config.rsync_workers * 4
+        if throttle:
+            count = max(count, THROTTLE_SHARDS)
+        shards = plan_shards(manifest, paths, count)
+
+        async def rsync_shard(i, shard):
+            async with rsync_semaphore:
+                return await rsync(
+                    f"{reason}, shard {i + 1}/{len(shards)}", shard, dest
+                )
+
+        results = await asyncio.gather(
+            *[rsync_shard(i, shard) for i, shard in enumerate(shards)]
+        )
+        logger.info(
+            f"Rsynced {len(shards)} shards ({reason}): "
+            f"{sum(progress.files for _, progress in results)} files, "
+            f"{sum(progress.sent_bytes for _, progress in results)} bytes sent"
+        )
+        return all(returncode in RSYNC_OK for returncode, _ in results)
+
+    async def sync_destinations(reason="sync", files=None, manifest=None) -> bool:
+        """Sync each top-level entry to the destination it is placed on"""
+        if len(placement.destinations) == 1:
+            destination = placement.destinations[0]
+            with destination.busy():
+                return await sharded_rsync(reason, files, manifest, destination.path)
+
+        if manifest is None:
+            manifest = await asyncio.to_thread(scan_manifest, config.src, files)
+        paths = files if files else await asyncio.to_thread(os.listdir, config.src)
+        by_top, groups = await asyncio.to_thread(top_level_groups, manifest, paths)
+        placed = await placement.place(groups, manifest)
+        parts = await asyncio.to_thread(split_by_destination, manifest, by_top, placed)
+
+        async def sync_destination(destination, part_paths, part_manifest, size):
+            with destination.busy():
+                ok = await sharded_rsync(
+                    f"{reason}, {destination.name}",
+                    part_paths,
+                    part_manifest,
+                    destination.path,
+                )
+            placement.synced(destination, size)
+            return ok
+
+        return all(
+            await asyncio.gather(
+                *[
+                    sync_destination(destination, *part)
+                    for destination, part in parts.items()
+                ]
+            )
+        )
+
+    async def add_linked(files, manifest):
+        """Add the synced paths hardlinked to the files of manifest, so rsync
+        links new hardlinks to them on the destination instead of copying"""
+        inodes = {meta.ino for meta in manifest.values() if meta.nlink > 1}
+        if not inodes:
+            return files, manifest
+        # The source is a single filesystem, inodes alone identify files
+        linked = await asyncio.to_thread(store.linked_paths, inodes)
+        linked = [path for path in linked if path not in manifest]
+        if not linked:
+            return files, manifest
+        linked_manifest = {
+            path: meta
+            for path, meta in (
+                await asyncio.to_thread(scan_manifest, config.src, linked)
+            ).items()
+            if meta.ino in inodes
+        }
+        return sorted(files + list(linked_manifest)), manifest | linked_manifest
+
+    async def sync_and_record(reason, files=None, manifest=None):
+        """Sync files, or the whole tree, and record the synced source state"""
+        async with sync_lock:
+            if manifest is None:
+                manifest = await asyncio.to_thread(scan_manifest, config.src, files)
+            if files is not None:
+                files, manifest = await add_linked(files, manifest)
+            if await sync_destinations(reason, files, manifest):
+                await asyncio.to_thread(
+                    store.save_synced_paths, manifest, files is None
+                )
+                publish_synced(manifest, files is None)
+
+    def publish_synced(manifest, full):
+        bus.publish(
+            SYNCED,
+            Synced({path: meta.size for path, meta in manifest.items()}, full),
+        )
+
+    async def full_sync(reason):
+        nonlocal last_full_sync
+        await sync_and_record(reason)
+        last_full_sync = time.monotonic()
+
+    async def stored_sync():
+        """Sync the files that changed on the source since the last recorded sync"""
+        previous = await asyncio.to_thread(store.synced_paths)
+        if not previous:
+            await manifest_sync()
+            return
+
+        manifest = await asyncio.to_thread(scan_manifest, config.src)
+        files = changed_paths(manifest, previous)
+        if files:
+            await sync_and_record(
+                f"initial sync of {len(files)} changed files",
+                files,
+                {path: manifest[path] for path in files},
+            )
+        else:
+            logger.info("Source unchanged since the last sync")
+
+    async def manifest_sync():
+        """Diff the source and destination manifests and sync the differences"""
+        nonlocal last_full_sync
+        source, *dest_manifests = await asyncio.gather(
+            asyncio.to_thread(scan_manifest, config.src),
+            *[
+                asyncio.to_thread(scan_manifest, destination.path)
+                for destination in placement.destinations
+            ],
+        )
+        dest = {}
+        roots = {}
+        for destination, dest_manifest in zip(placement.destinations, dest_manifests):
+            dest.update(dest_manifest)
+            if len(placement.destinations) > 1:
+                roots.update(dict.fromkeys(dest_manifest, destination.path))
+        files, links = diff_manifests(source, dest)
+        logger.info(
+            f"{len(files)} files to copy and {len(links)} hardlinks to recreate "
+            f"out of {len(source)} source files"
+        )
+
+        # Links are recreated next to the file they share, on its destination
+        links_by_root = {}
+        for existing, new in links:
+            root = roots.get(existing, placement.destinations[0].path)
+            links_by_root.setdefault(root, []).append((existing, new))
+        for root, root_links in links_by_root.items():
+            failed = await asyncio.to_thread(link_files, root, root_links)
+            if failed:
+                logger.warning(f"Failed to link {len(failed)} files, copying them")
+                files = sorted(files + failed)
+
+        if not files or await sync_destinations(
+            f"initial sync of {len(files)} files",
+            files,
+            {path: source[path] for path in files},
+        ):
+            await asyncio.to_thread(store.save_synced_paths, source, True)
+            publish_synced(source, True)
+            last_full_sync = time.monotonic()
 
     async def initial_sync():
         """Perform initial sync"""
@@ -94,7 +414,12 @@ async def run(config):
         if config.dry_run:
             logger.info("Dry run: initial sync")
         else:
-            await rsync("initial sync")
+            if config.initial_sync == "full":
+                await full_sync("initial sync")
+            elif config.initial_sync == "manifest":
+                await manifest_sync()
+            else:
+                await stored_sync()
             logger.info("Initial sync completed")
         initial_sync_done.set()
 
@@ -116,6 +441,22 @@ async def run(config):
                 except asyncio.TimeoutError:
                     break
 
+            INOTIFY_QUEUE_DEPTH.set(queue.qsize())
+
+            if config.dry_run:
+                if batch:
+                    changed_files = list(set(str(event.path) for event in batch))
+                    logger.info(
+                        f"Dry run: {len(batch)} events for files: {changed_files}"
+                    )
+                continue
+
+            if time.monotonic() - last_full_sync >= config.full_sync_interval:
+                await full_sync("full reconcile")
+                if batch:
+                    logger.info(f"Processed {len(batch)} file events")
+                continue
+
             if batch:
                 # Extract unique file paths from events
                 changed_files = list(set(str(event.path) for event in batch))
@@ -123,13 +464,93 @@ async def run(config):
                 for event in batch:
                     logger.debug(f"New file event for: {event.path}")
 
-                if config.dry_run:
-                    logger.info(
-                        f"Dry run: {len(batch)} events for files: {changed_files}"
+                files = await asyncio.to_thread(
+                    collapse_paths, changed_files, config.src
+                )
+                manifest = await asyncio.to_thread(scan_manifest, config.src, files)
+                size = sum(meta.size for meta in manifest.values())
+
+                if (
+                    len(files) > config.incremental_max_files
+                    or size / 1073741824 > config.incremental_max_size
+                ):
+                    await full_sync(
+                        f"{len(files)} changed paths of {size} bytes, too large "
+                        "for an incremental sync"
+                    )
+                elif files:
+                    await sync_and_record(
+                        f"file changes in {len(files)} paths", files, manifest
                     )
                 else:
-                    await rsync("file changes")
-                    logger.info(f"Processed {len(batch)} file events")
+                    logger.info("No files to sync, skipping rsync")
+                    continue
+
+                logger.info(f"Processed {len(batch)} file events")
+
+    async def monitor_load():
+        """Adjust the transfer throttle to the seeding load of the source"""
+        if not throttle:
+            return
+
+        while config.run:
+            try:
+                server_state = await asyncio.wait_for(load.get(), timeout=5)
+            except asyncio.TimeoutError:
+                continue
+            while not load.empty():
+                server_state = load.get_nowait()
+
+            previous, io_class = throttle.rate, throttle.io_class
+            throttle.update(server_state)
+            if abs(throttle.rate - previous) >= 1048576:
+                logger.info(
+                    f"Transfer limit {throttle.rate // 1048576} MB/s "
+                    f"(source load {throttle.pressure:.0%})"
+                )
+            if throttle.io_class != io_class:
+                # Runs in progress follow the new class, not only the next ones
+                for process in running:
+                    if process.returncode is None:
+                        throttle.apply_io_priority(process.pid)
+
+    async def sync_priority():
+        """Sync the paths the qb task is about to evict ahead of other changes"""
+        await initial_sync_done.wait()
+
+        while config.run:
+            try:
+                paths = await asyncio.wait_for(priority.get(), timeout=5)
+            except asyncio.TimeoutError:
+                continue
+            while not priority.empty():
+                paths.extend(priority.get_nowait())
+
+            if config.dry_run:
+                logger.info(f"Dry run: priority sync of {len(paths)} paths")
+                continue
+
+            files = await asyncio.to_thread(
+                collapse_paths,
+                [os.path.join(config.src, path) for path in paths],
+                config.src,
+            )
+            if files:
+                await sync_and_record(f"priority sync of {len(files)} paths", files)
+
+    async def maintain_transports():
+        """Keep the connections to remote targets open between syncs"""
+        while config.run:
+            for transport in transports.values():
+                if transport.remote and not await transport.connect():
+                    logger.warning(
+                        f"Cannot reach {transport.target}, retrying in "
+                        f"{CHECK_INTERVAL}s"
+                    )
+            for _ in range(CHECK_INTERVAL):
+                if not config.run:
+                    break
+                await asyncio.sleep(1)
 
     async def watch_and_queue():
         """Watch for file changes and queue them"""
@@ -137,12 +558,23 @@ async def run(config):
             if not config.run:
                 break
             queue.put_nowait(event)
+            INOTIFY_QUEUE_DEPTH.set(queue.qsize())
 
     logger.info("Starting rsync listener")
 
     # Run all tasks concurrently
     await asyncio.gather(
-        initial_sync(), process_events(), watch_and_queue(), return_exceptions=True
+        initial_sync(),
+        process_events(),
+        watch_and_queue(),
+        monitor_load(),
+        sync_priority(),
+        maintain_transports(),
+        return_exceptions=True,
     )
 
+    for transport in transports.values():
+        await transport.close()
+
+    copy_executor.shutdown(wait=False, cancel_futures=True)
     logger.info("Stopping rsync listener")
@@ -0,0 +1,103 @@
+import asyncio
+
+from qbrouter.utils.metrics import API_LATENCY
+from qbrouter.utils.qbclient import AsyncClient
+
+# Hashes sent in one request, keeping request bodies and query strings bounded
+MAX_HASHES = 500
+
+
+class RequestBatcher:
+    """Coalesces per-torrent calls into multi-hash API requests.
+
+    Calls for the same operation (and arguments) made within ``window`` seconds
+    of the first pending one are sent together as a single ``hashes=a|b|c``
+    request, or as soon as ``max_hashes`` are pending. Every caller awaits the
+    outcome of the request that carried its hash: its own torrent for ``info``,
+    the shared response or exception otherwise. Only calls awaited one after
+    the other are guaranteed to reach qBittorrent in order.
+    """
+
+    def __init__(
+        self, client: AsyncClient, window: float = 0.05, max_hashes: int = MAX_HASHES
+    ):
+        self.client = client
+        self.window = window
+        self.max_hashes = max_hashes
+        self._pending: dict[tuple, dict[str, list[asyncio.Future]]] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        self._requests: set[asyncio.Task] = set()
+
+    def _submit(self, key: tuple, torrent_hash: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, {})
+        batch.setdefault(torrent_hash, []).append(future)
+        if len(batch) >= self.max_hashes:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return future
+
+    def _flush(self, key: tuple):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            request = asyncio.create_task(self._send(key, batch))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _request(self, endpoint: str, hashes: list[str], *args):
+        if endpoint == "torrents/info":
+            torrents = await self.client.torrents_info(hashes=hashes)
+            return {torrent["hash"]: torrent for torrent in torrents or []}
+        if endpoint == "torrents/addTags":
+            return await self.client.torrents_add_tags(hashes, *args)
+        if endpoint == "torrents/stop":
+            return await self.client.torrents_stop(hashes)
+        if endpoint == "torrents/start":
+            return await self.client.torrents_start(hashes)
+        if endpoint == "torrents/delete":
+            return await self.client.torrents_delete(hashes, *args)
+        raise ValueError(f"Unknown batched endpoint {endpoint}")
+
+    async def _send(self, key: tuple, batch: dict[str, list[asyncio.Future]]):
+        endpoint, *args = key
+        try:
+            with API_LATENCY.time(endpoint=endpoint):
+                result = await self._request(endpoint, list(batch), *args)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for torrent_hash, futures in batch.items():
+            value = result.get(torrent_hash) if endpoint == "torrents/info" else result
+            for future in futures:
+                if not future.done():
+                    future.set_result(value)
+
+    async def info(self, torrent_hash: str) -> dict | None:
+        return await self._submit(("torrents/info",), torrent_hash)
+
+    async def add_tags(self, torrent_hash: str, tags: str):
+        return await self._submit(("torrents/addTags", tags), torrent_hash)
+
+    async def stop(self, torrent_hash: str):
+        return await self._submit(("torrents/stop",), torrent_hash)
+
+    async def start(self, torrent_hash: str):
+        return await self._submit(("torrents/start",), torrent_hash)
+
+    async def delete(self, torrent_hash: str, delete_files: bool = False):
+        return await self._submit(("torrents/delete", delete_files), torrent_hash)
+
+    async def flush(self):
+        """Send the pending calls now and wait for all requests in flight."""
+        for key in list(self._pending):
+            self._flush(key)
+        await asyncio.gather(*self._requests, return_exceptions=True)
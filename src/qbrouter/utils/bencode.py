@@ -0,0 +1,57 @@
+def bdecode(data: bytes):
+    """Decode bencoded data; strings stay bytes, dictionary keys included."""
+    value, end = _decode(data, 0)
+    if end != len(data):
+        raise ValueError(f"Trailing data at offset {end}")
+    return value
+
+
+def _decode(data: bytes, i: int):
+    token = data[i : i + 1]
+    if token == b"i":
+        end = data.index(b"e", i)
+        return int(data[i + 1 : end]), end + 1
+    if token == b"l":
+        items = []
+        i += 1
+        while data[i : i + 1] != b"e":
+            item, i = _decode(data, i)
+            items.append(item)
+        return items, i + 1
+    if token == b"d":
+        items = {}
+        i += 1
+        while data[i : i + 1] != b"e":
+            key, i = _decode(data, i)
+            items[key], i = _decode(data, i)
+        return items, i + 1
+    if token.isdigit():
+        colon = data.index(b":", i)
+        start = colon + 1
+        end = start + int(data[i:colon])
+        if end > len(data):
+            raise ValueError(f"String at offset {i} runs past the end")
+        return data[start:end], end
+    raise ValueError(f"Invalid bencode token {token!r} at offset {i}")
+
+
+def bencode(value) -> bytes:
+    """Encode ints, bytes, strings, lists and dicts, with dict keys sorted as
+    the spec requires."""
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    if isinstance(value, dict):
+        items = sorted(
+            (key.encode() if isinstance(key, str) else key, item)
+            for key, item in value.items()
+        )
+        return (
+            b"d" + b"".join(bencode(key) + bencode(item) for key, item in items) + b"e"
+        )
+    raise TypeError(f"Cannot bencode {type(value).__name__}")
@@ -0,0 +1,46 @@
+import asyncio
+from functools import cache
+from typing import NamedTuple
+
+# Topics
+SYNCED = "synced"
+PRIORITY = "priority"
+SERVER_STATE = "server_state"
+
+
+class Synced(NamedTuple):
+    """Source files (relative path -> size) now present on the destination;
+    ``full`` when they are the whole source tree."""
+
+    files: dict[str, int]
+    full: bool = False
+
+
+class EventBus:
+    """In-process publish/subscribe between the tasks of one event loop.
+
+    Every subscriber gets its own unbounded queue, so a slow consumer never
+    blocks the publisher.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[str, list[asyncio.Queue]] = {}
+
+    def subscribe(self, topic: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(topic, []).append(queue)
+        return queue
+
+    def unsubscribe(self, topic: str, queue: asyncio.Queue):
+        if queue in self._subscribers.get(topic, []):
+            self._subscribers[topic].remove(queue)
+
+    def publish(self, topic: str, payload):
+        for queue in self._subscribers.get(topic, []):
+            queue.put_nowait(payload)
+
+
+@cache
+def get_bus() -> EventBus:
+    """Return the bus shared by all tasks of the process."""
+    return EventBus()
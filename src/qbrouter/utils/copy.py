@@ -0,0 +1,241 @@
+import asyncio
+import errno
+import fcntl
+import os
+import shutil
+from concurrent.futures import Executor
+from logging import Logger
+from typing import NamedTuple
+
+from qbrouter.utils.manifest import FileMeta
+from qbrouter.utils.throttle import Throttle
+
+# ioctl request to clone a whole file (reflink) on btrfs, xfs, bcachefs...
+FICLONE = 0x40049409
+
+# Errors meaning a fast copy path is not available for this pair of files
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY}
+
+# Bytes copied between two throttle checks
+THROTTLE_CHUNK = 8388608
+
+
+class CopyStats(NamedTuple):
+    copied: int = 0
+    linked: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+
+
+def temp_path(path: str) -> str:
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.qbrouter")
+
+
+def same_file(meta: FileMeta, path: str) -> bool:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return (
+        st.st_size == meta.size
+        and st.st_mtime_ns // 1_000_000_000 == meta.mtime_ns // 1_000_000_000
+    )
+
+
+def prepare(src: str, dest: str, size: int) -> bool:
+    """Create the temp file for dest, returning True if it was reflinked."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp = temp_path(dest)
+    with open(src, "rb") as src_file, open(temp, "wb") as temp_file:
+        try:
+            fcntl.ioctl(temp_file.fileno(), FICLONE, src_file.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+        os.ftruncate(temp_file.fileno(), size)
+    return False
+
+
+def copy_range(
+    src: str, dest: str, offset: int, count: int, throttle: Throttle | None = None
+):
+    """Copy count bytes at offset from src into the temp file of dest."""
+    if throttle:
+        throttle.apply_io_priority()
+    # Copy in chunks when throttled so the rate can be enforced
+    chunk = THROTTLE_CHUNK if throttle else count
+    with open(src, "rb") as src_file, open(temp_path(dest), "r+b") as temp_file:
+        src_fd, temp_fd = src_file.fileno(), temp_file.fileno()
+        end = offset + count
+        try:
+            while offset < end:
+                size = min(chunk, end - offset)
+                if throttle:
+                    throttle.acquire(size)
+                copied = os.copy_file_range(src_fd, temp_fd, size, offset, offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+        # copy_file_range is not supported across these filesystems
+        os.lseek(temp_fd, offset, os.SEEK_SET)
+        while offset < end:
+            size = min(chunk, end - offset)
+            if throttle:
+                throttle.acquire(size)
+            sent = os.sendfile(temp_fd, src_fd, offset, size)
+            if not sent:
+                break
+            offset += sent
+
+
+def copy_xattrs(src: str, dest: str):
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA):
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(
+                dest, name, os.getxattr(src, name, follow_symlinks=False), 0, False
+            )
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+                raise
+
+
+def finalize(src: str, dest: str, meta: FileMeta):
+    """Copy ownership, mode, xattrs and times to the temp file and rename it
+    over dest."""
+    temp = temp_path(dest)
+    st = os.stat(src)
+    try:
+        os.chown(temp, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    os.chmod(temp, st.st_mode & 0o7777)
+    copy_xattrs(src, temp)
+    os.utime(temp, ns=(st.st_atime_ns, meta.mtime_ns))
+    os.replace(temp, dest)
+
+
+def link(existing: str, dest: str):
+    try:
+        if os.path.samefile(existing, dest):
+            return
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp = temp_path(dest)
+    try:
+        os.unlink(temp)
+    except FileNotFoundError:
+        pass
+    os.link(existing, temp)
+    os.replace(temp, dest)
+
+
+def discard(dest: str):
+    try:
+        os.unlink(temp_path(dest))
+    except OSError:
+        pass
+
+
+async def copy_files(
+    src_root,
+    dest_root,
+    manifest: dict[str, FileMeta],
+    executor: Executor,
+    concurrency: int,
+    split_size: int,
+    logger: Logger,
+    throttle: Throttle | None = None,
+) -> CopyStats:
+    """Copy the files of manifest from src_root to dest_root in a thread pool.
+
+    Files are reflinked when the filesystem supports it, otherwise copied with
+    copy_file_range (sendfile as a fallback), with files above ``split_size``
+    split into byte ranges copied in parallel. Data goes to a temp file that is
+    renamed over the destination once times, mode, ownership and xattrs are
+    set. Files unchanged by size and mtime are skipped, and hardlinked source
+    files are copied once and linked at the destination. An optional throttle
+    limits the copy rate and I/O class of the copying threads.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {field: 0 for field in CopyStats._fields}
+    copied_inodes = {}
+    directories = set()
+
+    def run(func, *args):
+        return loop.run_in_executor(executor, func, *args)
+
+    async def copy_one(path: str, meta: FileMeta):
+        src = os.path.join(src_root, path)
+        dest = os.path.join(dest_root, path)
+        directories.add(os.path.dirname(path))
+        async with semaphore:
+            try:
+                if await run(same_file, meta, dest):
+                    stats["skipped"] += 1
+                    return
+                if not await run(prepare, src, dest, meta.size):
+                    await asyncio.gather(
+                        *[
+                            run(copy_range, src, dest, offset, split_size, throttle)
+                            for offset in range(0, meta.size, split_size)
+                        ]
+                    )
+                await run(finalize, src, dest, meta)
+            except OSError as e:
+                logger.error(f"Failed to copy {path}: {e}")
+                stats["failed"] += 1
+                await run(discard, dest)
+                return
+        stats["copied"] += 1
+        stats["bytes"] += meta.size
+
+    async def link_one(path: str, existing: str):
+        try:
+            await run(
+                link,
+                os.path.join(dest_root, existing),
+                os.path.join(dest_root, path),
+            )
+            stats["linked"] += 1
+        except OSError as e:
+            logger.error(f"Failed to link {path} to {existing}: {e}")
+            stats["failed"] += 1
+
+    links = []
+    copies = []
+    for path, meta in manifest.items():
+        existing = copied_inodes.setdefault((meta.dev, meta.ino), path)
+        if existing != path and meta.nlink > 1:
+            links.append(link_one(path, existing))
+        else:
+            copies.append(copy_one(path, meta))
+
+    await asyncio.gather(*copies)
+    await asyncio.gather(*links)
+
+    # Adding files changed the directory times, copy them from the source last
+    for directory in sorted(directories, key=len, reverse=True):
+        try:
+            await run(
+                shutil.copystat,
+                os.path.join(src_root, directory),
+                os.path.join(dest_root, directory),
+            )
+        except OSError:
+            pass
+
+    return CopyStats(**stats)
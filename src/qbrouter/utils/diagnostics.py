@@ -0,0 +1,203 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Executor
+from pathlib import Path
+
+from qbrouter.logger import get_contextual_logger
+from qbrouter.utils.metrics import LOOP_LAG
+
+# Seconds between two event loop heartbeats
+LAG_INTERVAL = 0.5
+
+# Heartbeat delay logged as a warning
+LAG_WARNING = 1
+
+# Seconds without heartbeat after which the watchdog logs the loop thread stack
+STALL_SECONDS = 10
+
+# Longest profile that can be requested over HTTP
+MAX_PROFILE_SECONDS = 3600
+
+logger = get_contextual_logger("diagnostics")
+
+# Executors shown in reports, by name
+executors: dict[str, Executor] = {}
+
+
+def register_executor(name: str, executor: Executor):
+    executors[name] = executor
+
+
+def executor_usage(executor: Executor) -> str:
+    # Executors do not expose their usage, read it from their internals
+    max_workers = getattr(executor, "_max_workers", "?")
+    if hasattr(executor, "_threads"):
+        threads = len(executor._threads)
+        idle = executor._idle_semaphore._value
+        queued = executor._work_queue.qsize()
+        return (
+            f"{threads - idle} busy, {threads}/{max_workers} threads, {queued} queued"
+        )
+    processes = len(getattr(executor, "_processes", None) or {})
+    pending = len(getattr(executor, "_pending_work_items", {}))
+    return f"{processes}/{max_workers} processes, {pending} pending"
+
+
+def await_chain(task: asyncio.Task) -> list[str]:
+    """Format the frames of the coroutines a task is suspended in, down to the
+    future it waits for."""
+    lines = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        code = frame.f_code
+        lines.append(
+            f'  File "{code.co_filename}", line {frame.f_lineno}, in {code.co_name}\n'
+        )
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    # Tasks do not expose the future they wait for
+    waiter = getattr(task, "_fut_waiter", None)
+    if waiter is not None:
+        lines.append(f"  waiting for {waiter!r}\n")
+    return lines
+
+
+class Diagnostics:
+    """On demand reports of a running router and a toggled profiler.
+
+    ``report`` lists event loop lag, executor usage, the await chain of every
+    asyncio task and the stack of every thread. ``toggle_profiler`` runs
+    cProfile on the event loop thread for a number of seconds and writes the
+    stats to ``directory``. ``monitor`` measures the loop lag and starts a
+    watchdog thread that logs where the loop is stuck when it stops running.
+    """
+
+    def __init__(self, directory: Path, profile_seconds: int):
+        self.directory = directory
+        self.profile_seconds = profile_seconds
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._profiler: cProfile.Profile | None = None
+        self._profile_timer: asyncio.TimerHandle | None = None
+
+    async def monitor(self, config):
+        loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        watchdog = threading.Thread(
+            target=self._watch, args=(config,), name="watchdog", daemon=True
+        )
+        watchdog.start()
+
+        while config.run:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self._heartbeat = time.monotonic()
+            self.lag = max(0.0, loop.time() - start - LAG_INTERVAL)
+            self.max_lag = max(self.max_lag, self.lag)
+            LOOP_LAG.set(self.lag)
+            if self.lag >= LAG_WARNING:
+                logger.warning(f"Event loop was blocked for {self.lag:.2f}s")
+
+        if self._profiler:
+            self.stop_profiler()
+
+    def _watch(self, config):
+        reported = False
+        while config.run:
+            time.sleep(LAG_INTERVAL)
+            stalled = time.monotonic() - self._heartbeat
+            if stalled < STALL_SECONDS:
+                reported = False
+            elif not reported:
+                reported = True
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                logger.warning(
+                    f"Event loop has not run for {stalled:.0f}s, it is in:\n{stack}"
+                )
+
+    def report(self, query=None) -> str:
+        out = io.StringIO()
+        out.write(f"Event loop lag: {self.lag:.3f}s (max {self.max_lag:.3f}s)\n")
+
+        out.write("\nExecutors:\n")
+        loop = asyncio.get_running_loop()
+        default = getattr(loop, "_default_executor", None)
+        for name, executor in {"default": default, **executors}.items():
+            if executor is not None:
+                out.write(f"  {name}: {executor_usage(executor)}\n")
+
+        tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+        out.write(f"\nTasks ({len(tasks)}):\n")
+        for task in tasks:
+            out.write(f"{task.get_name()}: {task.get_coro().__qualname__}\n")
+            out.writelines(await_chain(task))
+
+        out.write("\nThreads:\n")
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self._loop_thread:
+                continue
+            out.write(f"{names.get(ident, ident)}:\n")
+            out.writelines(traceback.format_stack(frame))
+        return out.getvalue()
+
+    def dump(self) -> Path:
+        """Write a report to the diagnostics directory."""
+        path = self.directory / f"diagnostics-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        report = self.report()
+        path.write_text(report)
+        logger.info(f"Wrote diagnostics to {path}")
+        return path
+
+    def toggle_profiler(self, seconds: float | None = None) -> str:
+        if self._profiler:
+            return self.stop_profiler()
+
+        seconds = seconds or self.profile_seconds
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self._profile_timer = asyncio.get_running_loop().call_later(
+            seconds, self.stop_profiler
+        )
+        message = f"Profiling the event loop for {seconds}s"
+        logger.info(message)
+        return message
+
+    def stop_profiler(self) -> str:
+        if not self._profiler:
+            return "Profiler is not running"
+        self._profiler.disable()
+        self._profile_timer.cancel()
+        profiler, self._profiler = self._profiler, None
+
+        path = self.directory / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(50)
+        path.with_suffix(".txt").write_text(summary.getvalue())
+        message = f"Wrote profile to {path}"
+        logger.info(message)
+        return message
+
+    def profile_route(self, query: dict) -> str:
+        seconds = query.get("seconds")
+        if not seconds:
+            return self.toggle_profiler()
+        try:
+            value = float(seconds[0])
+        except ValueError:
+            raise ValueError(f"seconds must be a number, not {seconds[0]!r}")
+        if not 0 < value <= MAX_PROFILE_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+        return self.toggle_profiler(value)
@@ -1,28 +1,59 @@
 import asyncio
 import logging
+import re
+from typing import Callable
 from asyncio import create_subprocess_exec
-from asyncio.subprocess import PIPE
+from asyncio.subprocess import PIPE, Process
+
+# Progress output rewrites the same line with carriage returns
+LINE_END_RE = re.compile(rb"[\r\n]")
 
 
 async def _read_stream(stream, callback):
+    buffer = b""
     while True:
-        line = await stream.readline()
-        if line:
-            callback(line)
-        else:
+        chunk = await stream.read(65536)
+        if not chunk:
             break
+        *lines, buffer = LINE_END_RE.split(buffer + chunk)
+        for line in lines:
+            if line:
+                callback(line)
+    if buffer:
+        callback(buffer)
+
+
+def _log_and_forward(
+    logger: logging.Logger, on_output: Callable[[str], None], level: int
+):
+    def callback(line: bytes):
+        text = line.decode("UTF8", errors="replace")
+        logger.log(level, text)
+        if on_output:
+            on_output(text)
+
+    return callback
 
 
-async def execute(args: list[str], logger: logging.Logger):
+async def execute(
+    args: list[str],
+    logger: logging.Logger,
+    on_output: Callable[[str], None] | None = None,
+    level: int = logging.INFO,
+    on_start: Callable[[Process], None] | None = None,
+):
+    """Run a command, logging stdout lines at level and stderr as errors."""
     process = await create_subprocess_exec(*args, stdout=PIPE, stderr=PIPE)
+    if on_start:
+        on_start(process)
     await asyncio.gather(
         _read_stream(
             process.stdout,
-            lambda x: logger.info(x.decode("UTF8")),
+            _log_and_forward(logger, on_output, level),
         ),
         _read_stream(
             process.stderr,
-            lambda x: logger.error(x.decode("UTF8")),
+            lambda x: logger.error(x.decode("UTF8", errors="replace")),
         ),
     )
-    await process.wait()
+    return await process.wait()
@@ -1,7 +1,93 @@
 import os
+import stat
+from typing import Hashable, Iterable, Mapping
 
 
 def are_hardlinked(f1, f2):
     if not (os.path.isfile(f1) and os.path.isfile(f2)):
         return False
     return os.path.samefile(f1, f2) or (os.stat(f1).st_ino == os.stat(f2).st_ino)
+
+
+def file_inode(path) -> tuple[int, int] | None:
+    """Return the (st_dev, st_ino) key of a regular file, or None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_dev, st.st_ino
+
+
+def group_by_shared(
+    keys_by_item: Mapping[Hashable, Iterable[Hashable | None]],
+) -> list[list[Hashable]]:
+    """Group items that share at least one key.
+
+    Items meeting on the same key are merged with a union-find, so chains of
+    partial overlap end up in one group. None keys are ignored. Groups and their
+    members keep the order of ``keys_by_item``.
+    """
+    parent = {item: item for item in keys_by_item}
+
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    owners = {}
+    for item, keys in keys_by_item.items():
+        for key in keys:
+            if key is None:
+                continue
+            owner = owners.setdefault(key, item)
+            if owner != item:
+                root, other_root = find(item), find(owner)
+                if root != other_root:
+                    parent[root] = other_root
+
+    groups = {}
+    for item in keys_by_item:
+        groups.setdefault(find(item), []).append(item)
+    return list(groups.values())
+
+
+def group_hardlinked(
+    files_by_key: Mapping[Hashable, Iterable],
+) -> list[list[Hashable]]:
+    """Group keys whose files share at least one inode.
+
+    Every file is stat-ed once to build a (st_dev, st_ino) -> key index, so
+    groups that only partially overlap still end up together.
+    """
+    return group_by_shared(
+        {key: map(file_inode, files) for key, files in files_by_key.items()}
+    )
+
+
+def check_sizes(
+    directory, sizes: Mapping[str, int]
+) -> tuple[str | None, dict[str, tuple[int, int]]]:
+    """Check the files of one directory against their expected sizes.
+
+    The directory is listed with a single ``os.scandir`` and only the entries
+    named in ``sizes`` are stat-ed. Returns the path of the first file that is
+    missing or has the wrong size (None if all match), and the observed
+    name -> (st_size, st_mtime_ns) of the entries found.
+    """
+    observed = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name in sizes and entry.is_file():
+                    st = entry.stat()
+                    observed[entry.name] = st.st_size, st.st_mtime_ns
+    except OSError:
+        return str(directory), observed
+
+    for name, expected_size in sizes.items():
+        if observed.get(name, (None,))[0] != expected_size:
+            return os.path.join(directory, name), observed
+    return None, observed
@@ -0,0 +1,86 @@
+import time
+
+
+class FillForecast:
+    """Decides when to evict from the fill rate of the source disk.
+
+    Free space is kept between the ``low`` watermark (the floor) and the
+    ``high`` one. Eviction starts once free space is forecast to fall below the
+    floor within the lead time of moves and goes on until free space is back
+    above the high watermark. The lead time is two loop intervals (the next
+    check, and the first moves completing) plus the time to free the whole
+    watermark band at the measured move throughput.
+
+    The fill rate is the larger of the smoothed download speed and the
+    smoothed decline of free space, corrected for the space moves freed in the
+    meantime. Move throughput is smoothed from completed moves, ``concurrency``
+    of which run at once.
+    """
+
+    def __init__(
+        self,
+        low: int,
+        high: int,
+        interval: float,
+        concurrency: int = 1,
+        smoothing: float = 0.3,
+    ):
+        self.low = low
+        self.high = max(high, low)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.smoothing = smoothing
+        self.fill_rate = 0.0
+        self.download_rate = 0.0
+        self.move_rate: float | None = None
+        self.evicting = False
+        self._last: tuple[float, int] | None = None
+        self._freed = 0
+
+    def observe(self, free: int, download_speed: float):
+        """Record a free space reading and the download speed of the source."""
+        now = time.monotonic()
+        if self._last:
+            elapsed = now - self._last[0]
+            if elapsed > 0:
+                decline = max(self._last[1] - free + self._freed, 0) / elapsed
+                self.fill_rate += self.smoothing * (decline - self.fill_rate)
+        self.download_rate += self.smoothing * (download_speed - self.download_rate)
+        self._last = (now, free)
+        self._freed = 0
+
+    def moved(self, size: int, duration: float):
+        """Record a finished move that freed size bytes in duration seconds."""
+        self._freed += size
+        rate = size / max(duration, 1)
+        if self.move_rate is None:
+            self.move_rate = rate
+        else:
+            self.move_rate += self.smoothing * (rate - self.move_rate)
+
+    @property
+    def rate(self) -> float:
+        return max(self.fill_rate, self.download_rate)
+
+    @property
+    def lead_time(self) -> float:
+        if not self.move_rate:
+            return 2 * self.interval
+        return 2 * self.interval + (self.high - self.low) / (
+            self.move_rate * self.concurrency
+        )
+
+    def forecast(self, free: int) -> float:
+        """Free space expected after the lead time without eviction."""
+        return free - self.rate * self.lead_time
+
+    def should_evict(self, free: int) -> bool:
+        if self.forecast(free) < self.low:
+            self.evicting = True
+        elif free >= self.high:
+            self.evicting = False
+        return self.evicting
+
+    def bytes_needed(self, free: int) -> int:
+        """Bytes to free to be back at the high watermark after the lead time."""
+        return max(int(self.high - self.forecast(free)), 0)
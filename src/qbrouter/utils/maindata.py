@@ -0,0 +1,103 @@
+import asyncio
+
+from qbrouter.utils.metrics import API_LATENCY
+from qbrouter.utils.qbclient import AsyncClient
+from qbrouter.utils.store import StateStore, torrent_layout
+
+# Torrent fields whose change invalidates the cached file list
+FILE_LAYOUT_KEYS = {"save_path", "content_path", "name", "size"}
+
+
+class TorrentState:
+    """In-process mirror of a qBittorrent instance built from sync/maindata.
+
+    The first update fetches a full snapshot, after which only the torrents and
+    server_state fields that changed since the last ``rid`` are transferred.
+    File lists are kept in the optional store so they survive restarts.
+    """
+
+    def __init__(self, client: AsyncClient, store: StateStore | None = None):
+        self.client = client
+        self.store = store
+        self.rid = 0
+        self.torrents: dict[str, dict] = {}
+        self.server_state: dict = {}
+        self._files: dict[str, list[dict]] = {}
+        self._update_lock = asyncio.Lock()
+
+    async def update(self):
+        # Concurrent callers must not apply deltas for the same rid twice
+        async with self._update_lock:
+            return await self._update()
+
+    async def _update(self):
+        with API_LATENCY.time(endpoint="sync/maindata"):
+            data = await self.client.sync_maindata(rid=self.rid)
+
+        if data.get("full_update"):
+            self.torrents = {}
+            self.server_state = {}
+
+        for torrent_hash, delta in (data.get("torrents") or {}).items():
+            torrent = self.torrents.setdefault(torrent_hash, {"hash": torrent_hash})
+            if FILE_LAYOUT_KEYS & delta.keys():
+                self._files.pop(torrent_hash, None)
+            torrent.update(delta)
+
+        removed = data.get("torrents_removed") or []
+        for torrent_hash in removed:
+            self.torrents.pop(torrent_hash, None)
+
+        if self.store:
+            if data.get("full_update"):
+                removed = self.store.torrent_hashes() - self.torrents.keys()
+            if removed:
+                self.store.forget_torrents(removed)
+
+        for torrent_hash in self._files.keys() - self.torrents.keys():
+            del self._files[torrent_hash]
+
+        self.server_state.update(data.get("server_state") or {})
+        self.rid = data.get("rid", self.rid)
+        return self
+
+    def torrent(self, torrent_hash: str) -> dict | None:
+        return self.torrents.get(torrent_hash)
+
+    def completed(self) -> list[dict]:
+        return [
+            torrent
+            for torrent in self.torrents.values()
+            if torrent.get("progress", 0) >= 1
+        ]
+
+    def tagged(self, tag: str) -> list[dict]:
+        return sorted(
+            (
+                torrent
+                for torrent in self.completed()
+                if tag in map(str.strip, torrent.get("tags", "").split(","))
+            ),
+            key=lambda t: t["size"],
+        )
+
+    @property
+    def free_space_on_disk(self) -> int:
+        return self.server_state.get("free_space_on_disk", 0)
+
+    async def files(self, torrent_hash: str) -> list[dict]:
+        if torrent_hash in self._files:
+            return self._files[torrent_hash]
+
+        torrent = self.torrents.get(torrent_hash, {"hash": torrent_hash})
+        layout = torrent_layout(torrent)
+        files = self.store.files(torrent_hash, layout) if self.store else None
+
+        if files is None:
+            with API_LATENCY.time(endpoint="torrents/files"):
+                files = await self.client.torrents_files(torrent_hash)
+            if self.store:
+                self.store.save_files(torrent, layout, files)
+
+        self._files[torrent_hash] = files
+        return files
@@ -0,0 +1,113 @@
+import os
+import stat
+from typing import NamedTuple
+
+
+class FileMeta(NamedTuple):
+    size: int
+    mtime_ns: int
+    dev: int
+    ino: int
+    nlink: int
+
+
+def scan_manifest(root, paths=None) -> dict[str, FileMeta]:
+    """Stat every regular file below root, or below the given relative paths.
+
+    Returns a relative path -> FileMeta mapping. Directories are walked with an
+    explicit stack and ``os.scandir`` so deep trees do not recurse.
+    """
+    manifest = {}
+    stack = [os.path.join(root, path) for path in paths] if paths else [root]
+    while stack:
+        path = stack.pop()
+        try:
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                with os.scandir(path) as entries:
+                    stack.extend(entry.path for entry in entries)
+                continue
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            manifest[os.path.relpath(path, root)] = FileMeta(
+                st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, st.st_nlink
+            )
+    return manifest
+
+
+def changed_paths(current: dict[str, FileMeta], previous: dict) -> list[str]:
+    """Return the paths of current whose size, mtime or inode differ from
+    previous, together with every path hardlinked to one of them so rsync can
+    recreate the links."""
+    changed = {
+        path
+        for path, meta in current.items()
+        if previous.get(path) != (meta.size, meta.mtime_ns, meta.ino)
+    }
+
+    linked = {
+        (meta.dev, meta.ino) for path in changed if (meta := current[path]).nlink > 1
+    }
+    if linked:
+        changed.update(
+            path
+            for path, meta in current.items()
+            if meta.nlink > 1 and (meta.dev, meta.ino) in linked
+        )
+
+    return sorted(changed)
+
+
+def _same_file(meta: FileMeta, other: FileMeta | None) -> bool:
+    # rsync --times keeps whole seconds on every filesystem we sync to
+    return (
+        other is not None
+        and meta.size == other.size
+        and meta.mtime_ns // 1_000_000_000 == other.mtime_ns // 1_000_000_000
+    )
+
+
+def diff_manifests(
+    source: dict[str, FileMeta], dest: dict[str, FileMeta]
+) -> tuple[list[str], list[tuple[str, str]]]:
+    """Compare source and destination manifests.
+
+    Returns the source paths missing or different at the destination, and the
+    (existing, new) pairs of destination paths where the new file is a hardlink
+    of an already synced file on the source and can be linked instead of copied.
+    """
+    synced_inodes = {}
+    for path, meta in source.items():
+        if meta.nlink > 1 and _same_file(meta, dest.get(path)):
+            synced_inodes.setdefault((meta.dev, meta.ino), path)
+
+    files = []
+    links = []
+    for path, meta in source.items():
+        if _same_file(meta, dest.get(path)):
+            continue
+        existing = synced_inodes.get((meta.dev, meta.ino)) if meta.nlink > 1 else None
+        if existing is not None:
+            links.append((existing, path))
+        else:
+            files.append(path)
+
+    return sorted(files), links
+
+
+def link_files(root, links: list[tuple[str, str]]) -> list[str]:
+    """Create each new path under root as a hardlink of its existing path,
+    replacing whatever is there atomically. Returns the new paths that could
+    not be linked."""
+    failed = []
+    for existing, new in links:
+        target = os.path.join(root, new)
+        temp = os.path.join(os.path.dirname(target), f".{os.path.basename(new)}.link")
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(os.path.join(root, existing), temp)
+            os.replace(temp, target)
+        except OSError:
+            failed.append(new)
+    return failed
@@ -0,0 +1,221 @@
+import asyncio
+import bisect
+import inspect
+import math
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Callable
+from urllib.parse import parse_qs
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    900,
+    3600,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple, **extra) -> str:
+        return _format_labels({**dict(zip(self.labelnames, key)), **extra})
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(
+            f"{name}{labels} {_format_value(value)}"
+            for name, labels, value in self.samples()
+        )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, total, count = self._values[key]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        self._values[key][1:] = [total + value, count + 1]
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", self._labels(key, le=bound), cumulative
+            yield f"{self.name}_bucket", self._labels(key, le="+Inf"), count
+            yield f"{self.name}_sum", self._labels(key), total
+            yield f"{self.name}_count", self._labels(key), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+API_LATENCY = registry.register(
+    Histogram(
+        "qbrouter_api_request_seconds",
+        "qBittorrent API request latency",
+        ["endpoint"],
+    )
+)
+PASS_DURATION = registry.register(
+    Histogram("qbrouter_pass_seconds", "Duration of the tag and move passes", ["name"])
+)
+RSYNC_DURATION = registry.register(
+    Histogram("qbrouter_rsync_seconds", "Duration of rsync runs")
+)
+RSYNC_BYTES = registry.register(
+    Counter("qbrouter_rsync_bytes_total", "Bytes sent by rsync runs")
+)
+INOTIFY_QUEUE_DEPTH = registry.register(
+    Gauge("qbrouter_inotify_queue_depth", "File events waiting to be synced")
+)
+PENDING_MOVES = registry.register(
+    Gauge("qbrouter_pending_moves", "Torrents queued or in flight to the destination")
+)
+LOOP_LAG = registry.register(
+    Gauge("qbrouter_event_loop_lag_seconds", "Delay of the last event loop heartbeat")
+)
+
+# Plain text endpoints served next to /metrics: path -> handler(query), where
+# query is the parsed query string and the handler returns the body, or raises
+# ValueError for a bad request
+ROUTES: dict[str, Callable] = {}
+
+
+def add_route(path: str, handler: Callable):
+    ROUTES[path] = handler
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        method, target, *_ = request_line.decode("latin-1").split() + ["", ""]
+        path, _, query = target.partition("?")
+        if method == "GET" and path in ("/", "/metrics"):
+            status, body = "200 OK", registry.render().encode()
+        elif method == "GET" and path in ROUTES:
+            try:
+                body = ROUTES[path](parse_qs(query))
+                if inspect.isawaitable(body):
+                    body = await body
+                status, body = "200 OK", body.encode()
+            except ValueError as e:
+                status, body = "400 Bad Request", f"{e}\n".encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int, logger: Logger) -> asyncio.AbstractServer:
+    """Start the metrics HTTP endpoint on the running loop."""
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
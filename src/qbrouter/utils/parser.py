@@ -1,5 +1,7 @@
 import argparse
 import os
+from pathlib import Path
+from typing import NamedTuple
 
 
 class EnvDefault(argparse.Action):
@@ -13,3 +15,53 @@ class EnvDefault(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, values)
+
+
+class DestinationConfig(NamedTuple):
+    path: Path
+    url: str
+    username: str | None
+    password: str | None
+    target: str | None = None
+
+
+def _split(value: str | None, count: int, name: str) -> list:
+    if value is None:
+        return [None] * count
+    values = value.split(",")
+    if len(values) == 1:
+        return values * count
+    if len(values) != count:
+        raise argparse.ArgumentTypeError(
+            f"{name} lists {len(values)} values for {count} destinations"
+        )
+    return values
+
+
+def parse_destinations(config) -> list[DestinationConfig]:
+    """Pair the comma-separated destination paths, urls, credentials and rsync
+    targets; a single username or password applies to every destination."""
+    paths = config.dest.split(",")
+    urls = config.dest_url.split(",")
+    if len(urls) != len(paths):
+        raise argparse.ArgumentTypeError(
+            f"--dest-url lists {len(urls)} urls for {len(paths)} destinations"
+        )
+    targets = [None] * len(paths)
+    if config.dest_target:
+        targets = [target or None for target in config.dest_target.split(",")]
+        if len(targets) != len(paths):
+            raise argparse.ArgumentTypeError(
+                f"--dest-target lists {len(targets)} targets for {len(paths)} "
+                "destinations"
+            )
+    return [
+        DestinationConfig(Path(path), url, username, password, target)
+        for path, url, username, password, target in zip(
+            paths,
+            urls,
+            _split(config.dest_username, len(paths), "--dest-username"),
+            _split(config.dest_password, len(paths), "--dest-password"),
+            targets,
+        )
+    ]
@@ -0,0 +1,273 @@
+import asyncio
+import bisect
+import hashlib
+import os
+from concurrent.futures import Executor
+from typing import Callable, NamedTuple
+
+from qbrouter.utils.bencode import bdecode
+
+# BitTorrent v2 merkle trees hash 16 KiB blocks
+BLOCK_SIZE = 16384
+
+# Bytes hashed by one pool job, so big torrents spread over the workers and the
+# checkpoint moves forward regularly
+UNIT_SIZE = 268435456
+
+ZERO_HASH = bytes(32)
+
+
+class TorrentFile(NamedTuple):
+    length: int
+    padding: bool = False
+    pieces_root: bytes | None = None
+
+
+class PieceInfo(NamedTuple):
+    version: int
+    piece_length: int
+    files: list[TorrentFile]
+    # v1: concatenated SHA-1 piece hashes
+    pieces: bytes = b""
+    # v2: pieces root -> concatenated SHA-256 piece layer
+    layers: dict[bytes, bytes] = {}
+
+
+class Span(NamedTuple):
+    # None for padding files, which are all zeros and never on disk
+    path: str | None
+    offset: int
+    length: int
+
+
+class Unit(NamedTuple):
+    """A batch of consecutive pieces hashed by one pool job."""
+
+    version: int
+    piece_length: int
+    spans: list[Span]
+    # Expected hashes of the pieces, or the pieces root of a small v2 file
+    hashes: list[bytes]
+    small: bool = False
+
+
+def _v2_files(tree: dict, files: list):
+    for name, node in tree.items():
+        if b"" in node:
+            leaf = node[b""]
+            files.append(
+                TorrentFile(leaf.get(b"length", 0), False, leaf.get(b"pieces root"))
+            )
+        else:
+            _v2_files(node, files)
+    return files
+
+
+def parse_torrent(data: bytes) -> PieceInfo:
+    """Read the piece hashes of an exported .torrent, preferring v2 hashes for
+    hybrid torrents."""
+    torrent = bdecode(data)
+    info = torrent[b"info"]
+    piece_length = info[b"piece length"]
+
+    if info.get(b"meta version") == 2 and b"file tree" in info:
+        return PieceInfo(
+            2,
+            piece_length,
+            _v2_files(info[b"file tree"], []),
+            layers=torrent.get(b"piece layers", {}),
+        )
+
+    if b"files" in info:
+        files = [
+            TorrentFile(file[b"length"], b"p" in file.get(b"attr", b""))
+            for file in info[b"files"]
+        ]
+    else:
+        files = [TorrentFile(info[b"length"])]
+    return PieceInfo(1, piece_length, files, pieces=info[b"pieces"])
+
+
+def plan_units(info: PieceInfo, paths: list[str]) -> list[Unit]:
+    """Split the verification of a torrent into units of about UNIT_SIZE bytes.
+
+    ``paths`` are the data files on disk in torrent order, padding files
+    excluded.
+    """
+    data_files = [file for file in info.files if not file.padding]
+    if len(data_files) != len(paths):
+        raise ValueError(
+            f"Torrent has {len(data_files)} files, {len(paths)} paths given"
+        )
+    located = iter(paths)
+    spans = [
+        Span(None if file.padding else next(located), 0, file.length)
+        for file in info.files
+    ]
+    batch = max(1, UNIT_SIZE // info.piece_length)
+
+    units = []
+    if info.version == 1:
+        starts = []
+        total = 0
+        for span in spans:
+            starts.append(total)
+            total += span.length
+
+        count = len(info.pieces) // 20
+        for first in range(0, count, batch):
+            last = min(first + batch, count)
+            start, end = first * info.piece_length, min(last * info.piece_length, total)
+            unit_spans = []
+            index = bisect.bisect_right(starts, start) - 1
+            while start < end:
+                span = spans[index]
+                offset = start - starts[index]
+                length = min(span.length - offset, end - start)
+                if length > 0:
+                    unit_spans.append(Span(span.path, offset, length))
+                start += length
+                index += 1
+            units.append(
+                Unit(
+                    1,
+                    info.piece_length,
+                    unit_spans,
+                    [info.pieces[i * 20 : (i + 1) * 20] for i in range(first, last)],
+                )
+            )
+        return units
+
+    for file, span in zip(info.files, spans):
+        if not file.length:
+            continue
+        if file.length <= info.piece_length:
+            units.append(
+                Unit(2, info.piece_length, [span], [file.pieces_root], small=True)
+            )
+            continue
+        layer = info.layers[file.pieces_root]
+        count = len(layer) // 32
+        for first in range(0, count, batch):
+            last = min(first + batch, count)
+            offset = first * info.piece_length
+            length = min(last * info.piece_length, file.length) - offset
+            units.append(
+                Unit(
+                    2,
+                    info.piece_length,
+                    [Span(span.path, offset, length)],
+                    [layer[i * 32 : (i + 1) * 32] for i in range(first, last)],
+                )
+            )
+    return units
+
+
+def merkle_root(leaves: list[bytes], count: int) -> bytes:
+    """Root of a merkle tree of count leaves, missing leaves being zero."""
+    layer = leaves + [ZERO_HASH] * (count - len(leaves))
+    while len(layer) > 1:
+        layer = [
+            hashlib.sha256(layer[i] + layer[i + 1]).digest()
+            for i in range(0, len(layer), 2)
+        ]
+    return layer[0]
+
+
+def _read_spans(spans: list[Span], size: int):
+    """Yield the data of spans in chunks of size bytes."""
+    buffer = bytearray()
+    for span in spans:
+        if span.path is None:
+            buffer += bytes(span.length)
+        else:
+            with open(span.path, "rb", buffering=0) as f:
+                os.posix_fadvise(
+                    f.fileno(), span.offset, span.length, os.POSIX_FADV_SEQUENTIAL
+                )
+                f.seek(span.offset)
+                remaining = span.length
+                while remaining:
+                    chunk = f.read(min(remaining, max(size, 4194304)))
+                    if not chunk:
+                        raise EOFError(f"{span.path} is shorter than expected")
+                    buffer += chunk
+                    remaining -= len(chunk)
+                    while len(buffer) >= size:
+                        yield bytes(buffer[:size])
+                        del buffer[:size]
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def verify_unit(unit: Unit) -> bool:
+    """Hash the data of a unit and compare it to the expected piece hashes.
+
+    Runs in a worker process.
+    """
+    pieces = _read_spans(unit.spans, unit.piece_length)
+    try:
+        for expected in unit.hashes:
+            piece = next(pieces, None)
+            if piece is None:
+                return False
+            if unit.version == 1:
+                digest = hashlib.sha1(piece).digest()
+            else:
+                view = memoryview(piece)
+                leaves = [
+                    hashlib.sha256(view[i : i + BLOCK_SIZE]).digest()
+                    for i in range(0, len(piece), BLOCK_SIZE)
+                ]
+                # Small files are a tree of their own, padded to a power of two
+                count = (
+                    1 << (len(leaves) - 1).bit_length()
+                    if unit.small
+                    else unit.piece_length // BLOCK_SIZE
+                )
+                digest = merkle_root(leaves, count)
+            if digest != expected:
+                return False
+    except (OSError, EOFError):
+        return False
+    finally:
+        pieces.close()
+    return True
+
+
+async def verify_pieces(
+    units: list[Unit],
+    executor: Executor,
+    done: set[int],
+    on_progress: Callable[[set[int]], None] | None = None,
+) -> bool:
+    """Verify the units not in ``done`` in the executor.
+
+    ``done`` is updated as units pass and handed to ``on_progress`` so callers
+    can checkpoint it. Stops at the first mismatch.
+    """
+    loop = asyncio.get_running_loop()
+    pending = {
+        loop.run_in_executor(executor, verify_unit, unit): index
+        for index, unit in enumerate(units)
+        if index not in done
+    }
+    try:
+        while pending:
+            finished, _ = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in finished:
+                index = pending.pop(future)
+                if not future.result():
+                    return False
+                done.add(index)
+            if on_progress:
+                on_progress(done)
+    finally:
+        for future in pending:
+            future.cancel()
+    return True
@@ -0,0 +1,256 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from functools import cache
+from pathlib import Path
+
+from qbrouter.logger import get_contextual_logger
+from qbrouter.utils.batch import RequestBatcher
+from qbrouter.utils.maindata import TorrentState
+from qbrouter.utils.manifest import FileMeta
+from qbrouter.utils.qbclient import AsyncClient
+from qbrouter.utils.store import StateStore, open_store
+
+# Seconds a destination's free space reading is reused when placing
+REFRESH_INTERVAL = 30
+
+logger = get_contextual_logger("placement")
+
+
+class Destination:
+    """A cold qBittorrent instance and the directory its data is synced to."""
+
+    def __init__(
+        self, name: str, path: Path, client: AsyncClient, batch_window: float = 0.05
+    ):
+        self.name = name
+        self.path = path
+        self.client = client
+        self.batch = RequestBatcher(client, batch_window)
+        self.state = TorrentState(client)
+        # Bytes placed on the destination and not synced yet
+        self.pending = 0
+        # Syncs and moves to the destination in flight
+        self.active = 0
+        self.updated_at = 0.0
+
+    @property
+    def free_space(self) -> int:
+        return self.state.free_space_on_disk - self.pending
+
+    @contextmanager
+    def busy(self):
+        self.active += 1
+        try:
+            yield self
+        finally:
+            self.active -= 1
+
+    def __repr__(self):
+        return f"Destination({self.name}, {self.path})"
+
+
+class Placement:
+    """Assigns the top-level entries of the source (torrent content roots) to
+    destinations.
+
+    Entries keep their destination once placed, whether recorded in the store
+    or found on a destination disk. Hardlinked entries are placed as one group,
+    on the destination of the entries synced before with the same files.
+    A new group goes to the destination with the most free space left after
+    pending syncs, divided by its in-flight syncs and moves, among those that
+    keep ``reserve`` bytes free.
+    """
+
+    def __init__(self, destinations: list[Destination], store: StateStore, reserve):
+        self.destinations = destinations
+        self.by_name = {destination.name: destination for destination in destinations}
+        self.store = store
+        self.reserve = reserve
+        self._placements: dict[str, str] | None = None
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        if self._placements is None:
+            self._placements = await asyncio.to_thread(self.store.placements)
+
+    def _find_on_disk(self, entries) -> dict[str, Destination]:
+        return {
+            entry: destination
+            for entry in entries
+            for destination in self.destinations
+            if os.path.lexists(destination.path / entry)
+        }
+
+    async def _record(self, entries: list[str], destination: Destination):
+        for entry in entries:
+            self._placements[entry] = destination.name
+        await asyncio.to_thread(self.store.save_placements, entries, destination.name)
+
+    def _linked_entries(
+        self, groups: list[tuple[int, list[str]]], manifest: dict[str, FileMeta]
+    ) -> list[set[str]]:
+        """Return, for each group, the synced entries outside it that share
+        hardlinked files with it."""
+        inodes = {}
+        for path, meta in manifest.items():
+            if meta.nlink > 1:
+                inodes.setdefault(Path(path).parts[0], set()).add(meta.ino)
+
+        linked = []
+        for _, group in groups:
+            group_inodes = set().union(*(inodes.get(entry, ()) for entry in group))
+            paths = self.store.linked_paths(group_inodes) if group_inodes else []
+            linked.append({Path(path).parts[0] for path in paths} - set(group))
+        return linked
+
+    async def refresh(self):
+        """Update the free space of destinations read too long ago."""
+        now = time.monotonic()
+        stale = [d for d in self.destinations if now - d.updated_at >= REFRESH_INTERVAL]
+        results = await asyncio.gather(
+            *[destination.state.update() for destination in stale],
+            return_exceptions=True,
+        )
+        for destination, result in zip(stale, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to read the state of {destination}: {result}")
+            else:
+                destination.updated_at = now
+
+    def _choose(self, size: int) -> Destination:
+        candidates = [d for d in self.destinations if d.updated_at] or list(
+            self.destinations
+        )
+        fitting = [d for d in candidates if d.free_space - size >= self.reserve]
+        if not fitting:
+            logger.warning(f"No destination keeps {self.reserve} bytes free")
+            fitting = candidates
+        return max(fitting, key=lambda d: d.free_space / (1 + d.active))
+
+    async def destination_of(self, entry: str) -> Destination | None:
+        if len(self.destinations) == 1:
+            return self.destinations[0]
+        await self._load()
+        destination = self.by_name.get(self._placements.get(entry))
+        if destination is None:
+            # Entries synced without a recorded placement (a new store, or a
+            # destination added) are looked up on the destination disks
+            found = await asyncio.to_thread(self._find_on_disk, [entry])
+            if entry in found:
+                destination = found[entry]
+                await self._record([entry], destination)
+        return destination
+
+    async def place(
+        self,
+        groups: list[tuple[int, list[str]]],
+        manifest: dict[str, FileMeta] | None = None,
+    ) -> dict[str, Destination]:
+        """Return the destination of every entry of the (size, entries) groups,
+        placing the entries that have none yet.
+
+        ``manifest`` holds the files of the groups; hardlinks among them are
+        looked up in the synced paths to keep a group with entries synced
+        before it.
+        """
+        if len(self.destinations) == 1:
+            return {
+                entry: self.destinations[0] for _, group in groups for entry in group
+            }
+
+        async with self._lock:
+            await self._load()
+            unplaced = {
+                entry
+                for _, group in groups
+                for entry in group
+                if self._placements.get(entry) not in self.by_name
+            }
+            if not unplaced:
+                return {
+                    entry: self.by_name[self._placements[entry]]
+                    for _, group in groups
+                    for entry in group
+                }
+
+            found = await asyncio.to_thread(self._find_on_disk, unplaced)
+            linked = [set()] * len(groups)
+            if manifest:
+                linked = await asyncio.to_thread(self._linked_entries, groups, manifest)
+            await self.refresh()
+
+            placed = {}
+            for (size, group), linked_entries in zip(groups, linked):
+                known = {
+                    self.by_name[name]
+                    for entry in (*group, *linked_entries)
+                    if (name := self._placements.get(entry)) in self.by_name
+                }
+                new = [entry for entry in group if entry in unplaced]
+                if len(known) > 1:
+                    logger.warning(
+                        f"Hardlinked entries of {group[0]} are on {len(known)} "
+                        "destinations"
+                    )
+                if known:
+                    destination = next(iter(known))
+                elif on_disk := [found[entry] for entry in group if entry in found]:
+                    destination = on_disk[0]
+                else:
+                    destination = self._choose(size)
+                    destination.pending += size
+                    logger.info(
+                        f"Placing {group[0]} ({size} bytes) on {destination.name}"
+                    )
+                if new:
+                    await self._record(new, destination)
+                placed.update(
+                    (entry, self.by_name[self._placements[entry]]) for entry in group
+                )
+            return placed
+
+    def synced(self, destination: Destination, size: int):
+        """Release the pending bytes of a finished sync."""
+        destination.pending = max(0, destination.pending - size)
+
+
+@cache
+def _open_placement(
+    destinations: tuple,
+    state_db: str,
+    reserve: int,
+    api_concurrency: int,
+    batch_window: float,
+) -> Placement:
+    return Placement(
+        [
+            Destination(
+                destination.url,
+                destination.path,
+                AsyncClient(
+                    host=destination.url,
+                    username=destination.username,
+                    password=destination.password,
+                    limit_per_host=api_concurrency,
+                ),
+                batch_window,
+            )
+            for destination in destinations
+        ],
+        open_store(state_db),
+        reserve,
+    )
+
+
+def open_placement(config) -> Placement:
+    """Create the destinations of config once per process so all tasks share
+    their clients and state."""
+    return _open_placement(
+        tuple(config.destinations),
+        config.state_db,
+        config.dest_reserve * 1073741824,
+        config.api_concurrency,
+        config.batch_window / 1000,
+    )
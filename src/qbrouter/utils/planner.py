@@ -0,0 +1,124 @@
+import math
+
+# Cost added per moved group so that, at equal popularity, fewer moves win
+MOVE_COST = 0.001
+
+# Number of steps the bytes to free are quantized to
+RESOLUTION = 512
+
+# Groups above which candidates are narrowed to the best cost per byte
+MAX_CANDIDATES = 2000
+
+
+def group_score(group) -> float:
+    """Windowed upload rate of the group in MiB/s when known, else popularity."""
+    return group.get("upload_rate", group["popularity"])
+
+
+def group_cost(group) -> float:
+    return group_score(group) + MOVE_COST
+
+
+def eviction_order(group):
+    return group_score(group), -group["size"]
+
+
+def _total_cost(groups) -> float:
+    return sum(group_cost(group) for group in groups)
+
+
+def _solve(candidates, bytes_needed: int, resolution: int) -> list | None:
+    """Cheapest subset of candidates freeing at least bytes_needed, by a DP
+    over sizes rounded up to steps of 1/resolution of the need; None if the
+    candidates are not enough."""
+    weights = [-(-group["size"] * resolution // bytes_needed) for group in candidates]
+    costs = [group_cost(group) for group in candidates]
+
+    steps = resolution
+    while True:
+        # best[c] is the lowest cost that frees at least c steps
+        best = [0.0] + [math.inf] * steps
+        taken = []
+        for weight, cost in zip(weights, costs):
+            took = bytearray(steps + 1)
+            for c in range(steps, 0, -1):
+                candidate_cost = best[max(0, c - weight)] + cost
+                if candidate_cost < best[c]:
+                    best[c] = candidate_cost
+                    took[c] = 1
+            taken.append(took)
+
+        if math.isinf(best[steps]):
+            return None
+
+        chosen = []
+        c = steps
+        for i in reversed(range(len(candidates))):
+            if c > 0 and taken[i][c]:
+                chosen.append(candidates[i])
+                c = max(0, c - weights[i])
+
+        # Rounding up can make a set look larger than it is, ask for more
+        shortfall = bytes_needed - sum(group["size"] for group in chosen)
+        if shortfall <= 0:
+            return chosen
+        steps += -(-shortfall * resolution // bytes_needed)
+
+
+def plan_eviction(groups, bytes_needed: int, resolution: int = RESOLUTION) -> list:
+    """Pick the cheapest set of groups that frees at least ``bytes_needed``.
+
+    This is a min-cost covering knapsack: the cost of a group is its score
+    plus a small per-move overhead and its weight is its size, so groups are
+    ranked on upload rate (or popularity) per byte freed.
+
+    The cheapest group covering the need alone and the greedy set by cost per
+    byte bound the cost; only groups smaller than the need and cheaper than
+    that bound can improve on them. Those are solved with a DP over sizes
+    rounded up to 1/``resolution`` steps of the need, which never misses a set
+    that covers the need; when rounding made the picked set fall short, the
+    need is raised by the shortfall and the DP solved again. The result is
+    exact up to that rounding, unless more than ``MAX_CANDIDATES`` groups
+    remain, in which case only the best cost-per-byte ones covering twice the
+    need are kept. Returns the chosen groups in eviction order, or every group
+    if even all of them are not enough.
+    """
+    if bytes_needed <= 0:
+        return []
+
+    if sum(group["size"] for group in groups) < bytes_needed:
+        return sorted(groups, key=eviction_order)
+
+    by_cost_per_byte = sorted(groups, key=lambda g: group_cost(g) / max(g["size"], 1))
+    greedy = []
+    covered = 0
+    for group in by_cost_per_byte:
+        greedy.append(group)
+        covered += group["size"]
+        if covered >= bytes_needed:
+            break
+    solutions = [greedy]
+    covering = [group for group in groups if group["size"] >= bytes_needed]
+    if covering:
+        solutions.append([min(covering, key=group_cost)])
+    bound = min(_total_cost(solution) for solution in solutions)
+
+    candidates = [
+        group
+        for group in by_cost_per_byte
+        if group["size"] < bytes_needed and group_cost(group) < bound
+    ]
+    if len(candidates) > MAX_CANDIDATES:
+        narrowed = []
+        covered = 0
+        for group in candidates:
+            narrowed.append(group)
+            covered += group["size"]
+            if covered >= 2 * bytes_needed:
+                break
+        candidates = narrowed
+
+    chosen = _solve(candidates, bytes_needed, resolution)
+    if chosen is not None:
+        solutions.append(chosen)
+    return sorted(min(solutions, key=_total_cost), key=eviction_order)
@@ -0,0 +1,99 @@
+import re
+import time
+from typing import NamedTuple
+
+# "  1,234,567  45%   12.34MB/s    0:01:02 (xfr#3, to-chk=10/20)" from --info=progress2
+PROGRESS_RE = re.compile(
+    r"^\s*([\d,]+)\s+(\d+)%\s+([\d.]+\S*/s)\s+(\d+:\d{2}:\d{2})"
+    r"(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?"
+)
+# ">f+++++++++ path" from --itemize-changes
+ITEMIZE_RE = re.compile(r"^([<>ch.][fdLDS]\S{9}|\*deleting) +(.+)$")
+SENT_RE = re.compile(r"^sent ([\d,]+) bytes\s+received ([\d,]+) bytes")
+TOTAL_RE = re.compile(r"^total size is ([\d,]+)")
+
+
+def _int(value: str) -> int:
+    return int(value.replace(",", ""))
+
+
+class Item(NamedTuple):
+    changes: str
+    path: str
+
+    @property
+    def transferred(self) -> bool:
+        # "<" or ">" means the file content was sent
+        return self.changes[0] in "<>" and self.changes[1] == "f"
+
+
+class RsyncProgress:
+    """Aggregate the output of one rsync run into transfer statistics.
+
+    Feed it every output line (progress updates are separated by carriage
+    returns). It keeps the latest progress2 figures, counts itemized changes
+    and reads the final stats, and ``due`` tells when another periodic summary
+    should be logged. Itemized records are returned by ``feed``, not kept.
+    """
+
+    def __init__(self, interval: float = 30):
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self._reported_at = self.started_at
+        self.bytes = 0
+        self.percent = 0
+        self.rate = ""
+        self.eta = ""
+        self.to_check = None
+        self.total_files = None
+        self.files = 0
+        self.directories = 0
+        self.deleted = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.total_size = 0
+
+    def feed(self, line: str) -> Item | None:
+        """Parse one output line, returning the itemize record it holds."""
+        line = line.rstrip("\r\n")
+        if match := PROGRESS_RE.match(line):
+            self.bytes = _int(match.group(1))
+            self.percent = int(match.group(2))
+            self.rate, self.eta = match.group(3), match.group(4)
+            if match.group(5):
+                self.to_check = int(match.group(6))
+                self.total_files = int(match.group(7))
+        elif match := ITEMIZE_RE.match(line):
+            item = Item(match.group(1), match.group(2))
+            if item.changes == "*deleting":
+                self.deleted += 1
+            elif item.transferred:
+                self.files += 1
+            elif item.changes[1] == "d":
+                self.directories += 1
+            return item
+        elif match := SENT_RE.match(line):
+            self.sent_bytes = _int(match.group(1))
+            self.received_bytes = _int(match.group(2))
+        elif match := TOTAL_RE.match(line):
+            self.total_size = _int(match.group(1))
+        return None
+
+    def due(self) -> bool:
+        now = time.monotonic()
+        if now - self._reported_at < self.interval:
+            return False
+        self._reported_at = now
+        return True
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        text = (
+            f"{self.files} files transferred, {self.bytes} bytes "
+            f"({self.percent}%) in {elapsed:.0f}s"
+        )
+        if self.rate:
+            text += f" at {self.rate}, eta {self.eta}"
+        if self.total_files:
+            text += f", {self.to_check}/{self.total_files} files left to check"
+        return text
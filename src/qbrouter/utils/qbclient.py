@@ -0,0 +1,210 @@
+import asyncio
+from typing import Iterable
+
+import aiohttp
+
+# Torrent states, see https://github.com/qbittorrent/qBittorrent/wiki/WebUI-API-(qBittorrent-5.0)
+STOPPED_STATES = {"pausedUP", "pausedDL", "stoppedUP", "stoppedDL"}
+UPLOADING_STATES = {"uploading", "stalledUP", "checkingUP", "queuedUP", "forcedUP"}
+CHECKING_STATES = {"checkingUP", "checkingDL", "checkingResumeData"}
+
+
+def is_stopped(torrent) -> bool:
+    return torrent["state"] in STOPPED_STATES
+
+
+def is_uploading(torrent) -> bool:
+    return torrent["state"] in UPLOADING_STATES
+
+
+def is_checking(torrent) -> bool:
+    return torrent["state"] in CHECKING_STATES
+
+
+def join_hashes(hashes: str | Iterable[str]) -> str:
+    return hashes if isinstance(hashes, str) else "|".join(hashes)
+
+
+class QBittorrentError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncClient:
+    """Async client for the qBittorrent WebUI API endpoints qb-router uses.
+
+    Requests share one keep-alive session per instance, limited to
+    ``limit_per_host`` concurrent connections. The session logs in lazily and
+    logs in again once when a request is rejected with 403.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        username: str | None = None,
+        password: str | None = None,
+        limit_per_host: int = 8,
+        timeout: float = 60,
+    ):
+        self.host = host.rstrip("/")
+        self.username = username
+        self.password = password
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+        self._login_lock = asyncio.Lock()
+        self._logged_in = False
+        self._legacy_stop = False
+
+    def _url(self, path: str) -> str:
+        return f"{self.host}/api/v2/{path}"
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.limit_per_host),
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                headers={"Referer": self.host},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._logged_in = False
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def login(self, force: bool = False):
+        async with self._login_lock:
+            if self._logged_in and not force:
+                return
+            if self.username is not None:
+                async with self.session().post(
+                    self._url("auth/login"),
+                    data={"username": self.username, "password": self.password or ""},
+                ) as response:
+                    text = await response.text()
+                    if response.status != 200 or text.strip() != "Ok.":
+                        raise QBittorrentError(
+                            f"Login to {self.host} failed: {response.status} {text}",
+                            response.status,
+                        )
+            self._logged_in = True
+
+    async def request(self, method: str, path: str, read="json", **kwargs):
+        await self.login()
+        for attempt in range(2):
+            async with self.session().request(
+                method, self._url(path), **kwargs
+            ) as response:
+                if response.status == 403 and attempt == 0:
+                    await self.login(force=True)
+                    continue
+                if response.status >= 400:
+                    raise QBittorrentError(
+                        f"{method} {path} failed: {response.status} "
+                        f"{await response.text()}",
+                        response.status,
+                    )
+                if read == "json":
+                    return await response.json(content_type=None)
+                if read == "bytes":
+                    return await response.read()
+                return await response.text()
+
+    async def app_default_save_path(self) -> str:
+        return await self.request("GET", "app/defaultSavePath", read="text")
+
+    async def sync_maindata(self, rid: int = 0) -> dict:
+        return await self.request("GET", "sync/maindata", params={"rid": rid})
+
+    async def torrents_info(self, hashes=None, **params) -> list[dict]:
+        if hashes is not None:
+            params["hashes"] = join_hashes(hashes)
+        return await self.request("GET", "torrents/info", params=params)
+
+    async def torrents_files(self, torrent_hash: str) -> list[dict]:
+        return await self.request(
+            "GET", "torrents/files", params={"hash": torrent_hash}
+        )
+
+    async def torrents_export(self, torrent_hash: str) -> bytes:
+        return await self.request(
+            "GET", "torrents/export", read="bytes", params={"hash": torrent_hash}
+        )
+
+    async def torrents_add(
+        self,
+        torrent_files: bytes,
+        save_path: str | None = None,
+        category: str | None = None,
+        tags: str | None = None,
+        use_auto_torrent_management: bool | None = None,
+        **options,
+    ) -> str:
+        form = aiohttp.FormData()
+        form.add_field(
+            "torrents",
+            torrent_files,
+            filename="torrent.torrent",
+            content_type="application/x-bittorrent",
+        )
+        fields = {
+            "savepath": save_path,
+            "category": category,
+            "tags": tags,
+            "autoTMM": use_auto_torrent_management,
+            **options,
+        }
+        for name, value in fields.items():
+            if value is None:
+                continue
+            form.add_field(
+                name, str(value).lower() if isinstance(value, bool) else str(value)
+            )
+        return await self.request("POST", "torrents/add", read="text", data=form)
+
+    async def _stop_or_start(self, action: str, legacy_action: str, hashes):
+        data = {"hashes": join_hashes(hashes)}
+        if not self._legacy_stop:
+            try:
+                return await self.request(
+                    "POST", f"torrents/{action}", read="text", data=data
+                )
+            except QBittorrentError as e:
+                if e.status != 404:
+                    raise
+                # qBittorrent < 5.0 only knows pause/resume
+                self._legacy_stop = True
+        return await self.request(
+            "POST", f"torrents/{legacy_action}", read="text", data=data
+        )
+
+    async def torrents_stop(self, hashes):
+        return await self._stop_or_start("stop", "pause", hashes)
+
+    async def torrents_start(self, hashes):
+        return await self._stop_or_start("start", "resume", hashes)
+
+    async def torrents_delete(self, hashes, delete_files: bool = False):
+        return await self.request(
+            "POST",
+            "torrents/delete",
+            read="text",
+            data={
+                "hashes": join_hashes(hashes),
+                "deleteFiles": str(delete_files).lower(),
+            },
+        )
+
+    async def torrents_add_tags(self, hashes, tags: str | Iterable[str]):
+        return await self.request(
+            "POST",
+            "torrents/addTags",
+            read="text",
+            data={
+                "hashes": join_hashes(hashes),
+                "tags": tags if isinstance(tags, str) else ",".join(tags),
+            },
+        )
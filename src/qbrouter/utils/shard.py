@@ -0,0 +1,53 @@
+import heapq
+from pathlib import Path
+
+from qbrouter.utils.file import group_by_shared
+from qbrouter.utils.manifest import FileMeta
+
+
+def top_level_groups(
+    manifest: dict[str, FileMeta], paths
+) -> tuple[dict[str, list[str]], list[tuple[int, list[str]]]]:
+    """Bucket relative paths by their top-level entry (one torrent content
+    root) and group the entries that share hardlinked files in ``manifest``.
+
+    Returns the paths of each entry and the (size, entries) groups, largest
+    first.
+    """
+    by_top = {}
+    for path in paths:
+        by_top.setdefault(Path(path).parts[0], []).append(path)
+
+    sizes = dict.fromkeys(by_top, 0)
+    linked = {top: [] for top in by_top}
+    for path, meta in manifest.items():
+        top = Path(path).parts[0]
+        if top not in sizes:
+            continue
+        sizes[top] += meta.size
+        if meta.nlink > 1:
+            linked[top].append((meta.dev, meta.ino))
+
+    groups = group_by_shared(linked)
+    return by_top, sorted(
+        ((sum(sizes[top] for top in group), group) for group in groups),
+        key=lambda x: -x[0],
+    )
+
+
+def plan_shards(manifest: dict[str, FileMeta], paths, count: int) -> list[list[str]]:
+    """Split relative paths into at most ``count`` shards for parallel rsyncs.
+
+    Top-level entries that share hardlinked files are kept in the same shard so
+    ``--hard-links`` still sees every link of a group. Groups are assigned
+    largest first to the least loaded shard; the result is ordered by size.
+    """
+    by_top, sized_groups = top_level_groups(manifest, paths)
+
+    shards = [(0, i, []) for i in range(min(count, len(sized_groups)))]
+    for size, group in sized_groups:
+        shard_size, i, shard_paths = heapq.heappop(shards)
+        shard_paths.extend(path for top in group for path in by_top[top])
+        heapq.heappush(shards, (shard_size + size, i, shard_paths))
+
+    return [shard_paths for _, _, shard_paths in sorted(shards, reverse=True)]
@@ -0,0 +1,349 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import cache
+from typing import Iterable, NamedTuple
+
+from qbrouter.utils.manifest import FileMeta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    hash TEXT PRIMARY KEY,
+    name TEXT,
+    files_layout TEXT,
+    layout TEXT,
+    verified_at REAL,
+    synced INTEGER NOT NULL DEFAULT 0,
+    tagged_at REAL
+);
+CREATE TABLE IF NOT EXISTS torrent_files (
+    hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    file_index INTEGER,
+    PRIMARY KEY (hash, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS synced_paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS synced_paths_inode ON synced_paths (inode);
+CREATE TABLE IF NOT EXISTS moves (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL,
+    name TEXT,
+    size INTEGER,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS piece_checkpoints (
+    hash TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    done TEXT NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS placements (
+    entry TEXT PRIMARY KEY,
+    destination TEXT NOT NULL,
+    placed_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS upload_history (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    interval INTEGER NOT NULL,
+    slots INTEGER NOT NULL,
+    slot INTEGER,
+    hashes TEXT NOT NULL,
+    uploaded BLOB NOT NULL,
+    first BLOB NOT NULL,
+    buckets BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class Verification(NamedTuple):
+    layout: str
+    verified_at: float
+    synced: bool
+
+
+def torrent_layout(torrent) -> str:
+    """Fingerprint of the torrent fields that decide where its files live."""
+    return "|".join(
+        str(torrent.get(key, ""))
+        for key in ("save_path", "content_path", "name", "size")
+    )
+
+
+class StateStore:
+    """SQLite (WAL) store for what qb-router learned before a restart.
+
+    Keeps per-torrent file manifests, verification results and piece hash
+    checkpoints, the source manifest of the last successful rsync, the
+    destination of each synced entry, the upload history and the move history.
+    The methods are blocking; call them through ``asyncio.to_thread`` for bulk
+    work.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        columns = {
+            row[1] for row in self._db.execute("PRAGMA table_info(torrent_files)")
+        }
+        if "file_index" not in columns:
+            # File lists stored without their order are fetched again
+            with self._db:
+                self._db.execute(
+                    "ALTER TABLE torrent_files ADD COLUMN file_index INTEGER"
+                )
+                self._db.execute("UPDATE torrents SET files_layout = NULL")
+        if "dest_size" in columns and sqlite3.sqlite_version_info >= (3, 35, 0):
+            # Destination metadata was recorded by older versions, never read
+            with self._db:
+                self._db.execute("ALTER TABLE torrent_files DROP COLUMN dest_size")
+                self._db.execute("ALTER TABLE torrent_files DROP COLUMN dest_mtime_ns")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def files(self, torrent_hash: str, layout: str) -> list[dict] | None:
+        """Return the stored file list of a torrent, in torrent order, if its
+        layout is unchanged."""
+        with self._lock:
+            if not self._db.execute(
+                "SELECT 1 FROM torrents WHERE hash = ? AND files_layout = ?",
+                (torrent_hash, layout),
+            ).fetchone():
+                return None
+            return [
+                {"name": path, "size": size, "index": index}
+                for path, size, index in self._db.execute(
+                    "SELECT path, size, file_index FROM torrent_files "
+                    "WHERE hash = ? ORDER BY file_index",
+                    (torrent_hash,),
+                )
+            ]
+
+    def save_files(self, torrent, layout: str, files: list[dict]):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO torrents (hash, name, files_layout) VALUES (?, ?, ?) "
+                "ON CONFLICT (hash) DO UPDATE SET name = excluded.name, "
+                "files_layout = excluded.files_layout",
+                (torrent["hash"], torrent.get("name"), layout),
+            )
+            self._db.execute(
+                "DELETE FROM torrent_files WHERE hash = ?", (torrent["hash"],)
+            )
+            self._db.executemany(
+                "INSERT INTO torrent_files (hash, path, size, file_index) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (torrent["hash"], file["name"], file["size"], file.get("index", i))
+                    for i, file in enumerate(files)
+                ),
+            )
+
+    def verification(self, torrent_hash: str) -> Verification | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT layout, verified_at, synced FROM torrents "
+                "WHERE hash = ? AND verified_at IS NOT NULL",
+                (torrent_hash,),
+            ).fetchone()
+        return Verification(row[0], row[1], bool(row[2])) if row else None
+
+    def save_verification(self, torrent, layout: str, synced: bool):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO torrents (hash, name, layout, verified_at, synced) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (hash) DO UPDATE SET "
+                "name = excluded.name, layout = excluded.layout, "
+                "verified_at = excluded.verified_at, synced = excluded.synced",
+                (torrent["hash"], torrent.get("name"), layout, now, int(synced)),
+            )
+
+    def mark_tagged(self, torrent_hashes: Iterable[str]):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE torrents SET tagged_at = ? WHERE hash = ?",
+                ((now, torrent_hash) for torrent_hash in torrent_hashes),
+            )
+
+    def torrent_hashes(self) -> set[str]:
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT hash FROM torrents")}
+
+    def forget_torrents(self, torrent_hashes: Iterable[str]):
+        torrent_hashes = [(torrent_hash,) for torrent_hash in torrent_hashes]
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM torrents WHERE hash = ?", torrent_hashes)
+            self._db.executemany(
+                "DELETE FROM torrent_files WHERE hash = ?", torrent_hashes
+            )
+            self._db.executemany(
+                "DELETE FROM piece_checkpoints WHERE hash = ?", torrent_hashes
+            )
+
+    def piece_checkpoint(self, torrent_hash: str, fingerprint: str) -> set[int]:
+        """Return the verified piece units of a torrent if its destination
+        files are unchanged since they were checked."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT done FROM piece_checkpoints WHERE hash = ? AND fingerprint = ?",
+                (torrent_hash, fingerprint),
+            ).fetchone()
+        return set(json.loads(row[0])) if row else set()
+
+    def save_piece_checkpoint(
+        self, torrent_hash: str, fingerprint: str, done: Iterable[int]
+    ):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO piece_checkpoints "
+                "(hash, fingerprint, done, updated_at) VALUES (?, ?, ?, ?)",
+                (torrent_hash, fingerprint, json.dumps(sorted(done)), time.time()),
+            )
+
+    def clear_piece_checkpoint(self, torrent_hash: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM piece_checkpoints WHERE hash = ?", (torrent_hash,)
+            )
+
+    def placements(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._db.execute("SELECT entry, destination FROM placements"))
+
+    def save_placements(self, entries: Iterable[str], destination: str):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO placements (entry, destination, placed_at) "
+                "VALUES (?, ?, ?)",
+                ((entry, destination, now) for entry in entries),
+            )
+
+    def upload_history(self) -> tuple | None:
+        """Return the last UploadHistory dump."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT interval, slots, slot, hashes, uploaded, first, buckets "
+                "FROM upload_history"
+            ).fetchone()
+        if not row:
+            return None
+        return (*row[:3], json.loads(row[3]), *row[4:])
+
+    def save_upload_history(
+        self, interval, slots, slot, hashes, uploaded, first, buckets
+    ):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO upload_history (id, interval, slots, slot, "
+                "hashes, uploaded, first, buckets) VALUES (0, ?, ?, ?, ?, ?, ?, ?)",
+                (interval, slots, slot, json.dumps(hashes), uploaded, first, buckets),
+            )
+
+    def record_move(self, torrent, started_at: float, finished_at: float, result: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO moves (hash, name, size, started_at, finished_at, result) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    torrent["hash"],
+                    torrent.get("name"),
+                    torrent.get("size"),
+                    started_at,
+                    finished_at,
+                    result,
+                ),
+            )
+
+    def moves(self, since: float = 0) -> list[tuple]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT hash, name, size, started_at, finished_at, result FROM moves "
+                "WHERE finished_at >= ? ORDER BY finished_at",
+                (since,),
+            ).fetchall()
+
+    def synced_paths(self) -> dict[str, tuple[int, int, int]]:
+        """Return the source manifest recorded by the last successful syncs."""
+        with self._lock:
+            return {
+                path: (size, mtime_ns, inode)
+                for path, size, mtime_ns, inode in self._db.execute(
+                    "SELECT path, size, mtime_ns, inode FROM synced_paths"
+                )
+            }
+
+    def linked_paths(self, inodes: Iterable[int]) -> list[str]:
+        """Return the synced paths of the given source inodes."""
+        with self._lock:
+            return [
+                path
+                for inode in inodes
+                for (path,) in self._db.execute(
+                    "SELECT path FROM synced_paths WHERE inode = ?", (inode,)
+                )
+            ]
+
+    def save_synced_paths(self, manifest: dict[str, FileMeta], replace: bool = False):
+        """Record source files as synced; ``replace`` drops every other path."""
+        with self._lock, self._db:
+            if replace:
+                self._db.execute("DELETE FROM synced_paths")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO synced_paths (path, size, mtime_ns, inode) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (path, meta.size, meta.mtime_ns, meta.ino)
+                    for path, meta in manifest.items()
+                ),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("last_rsync_at", json.dumps(time.time())),
+            )
+
+
+@cache
+def open_store(path: str) -> StateStore:
+    """Open the store at path once per process so all tasks share it."""
+    return StateStore(path)
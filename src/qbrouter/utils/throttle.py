@@ -0,0 +1,127 @@
+import ctypes
+import platform
+import threading
+import time
+
+# I/O scheduling classes, see ioprio_set(2)
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "i686": 289}
+
+# qBittorrent disk queue figures considered fully busy
+BUSY_IO_JOBS = 64
+BUSY_QUEUE_TIME_MS = 1000
+
+# Pressure above which transfers drop to the idle I/O class
+IDLE_PRESSURE = 0.5
+
+_libc = None
+
+
+def set_io_priority(io_class: int, level: int = 7, pid: int = 0) -> bool:
+    """Set the I/O scheduling class of a process, or the calling thread."""
+    global _libc
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return False
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    value = io_class << 13 | (level if io_class == IOPRIO_CLASS_BE else 0)
+    return _libc.syscall(nr, IOPRIO_WHO_PROCESS, pid, value) == 0
+
+
+def process_tree(pid: int) -> list[int]:
+    """Return pid and the pids of its descendants."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def ionice_args(io_class: int) -> list[str]:
+    if io_class == IOPRIO_CLASS_IDLE:
+        return ["ionice", "-c", "3"]
+    return ["ionice", "-c", "2", "-n", "7"]
+
+
+def _float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Throttle:
+    """Bandwidth limit for transfers that backs off under seeding load.
+
+    ``update`` reads the source qBittorrent server_state: upload speed relative
+    to its limit (or the highest speed seen), queued disk jobs, disk queue time
+    and cache overload. The smoothed pressure moves the rate between
+    ``ceiling`` and ``floor`` bytes per second and switches transfers to the
+    idle I/O class when the disk is busy. ``acquire`` is a token bucket that
+    copy threads call before moving data.
+    """
+
+    def __init__(self, floor: int, ceiling: int, smoothing: float = 0.3):
+        self.floor = min(floor, ceiling)
+        self.ceiling = ceiling
+        self.smoothing = smoothing
+        self.pressure = 0.0
+        self.rate = ceiling
+        self.io_class = IOPRIO_CLASS_BE
+        self._peak_upload = 0.0
+        self._lock = threading.Lock()
+        self._allowance = 0.0
+        self._checked = time.monotonic()
+
+    def update(self, server_state: dict) -> int:
+        upload = _float(server_state.get("up_info_speed"))
+        self._peak_upload = max(self._peak_upload * 0.99, upload)
+        upload_limit = _float(server_state.get("up_rate_limit")) or self._peak_upload
+
+        pressure = max(
+            upload / upload_limit if upload_limit else 0,
+            _float(server_state.get("queued_io_jobs")) / BUSY_IO_JOBS,
+            _float(server_state.get("average_time_queue")) / BUSY_QUEUE_TIME_MS,
+            _float(server_state.get("read_cache_overload")) / 100,
+            _float(server_state.get("write_cache_overload")) / 100,
+        )
+        pressure = min(max(pressure, 0.0), 1.0)
+        self.pressure += self.smoothing * (pressure - self.pressure)
+
+        self.rate = int(self.ceiling - (self.ceiling - self.floor) * self.pressure)
+        self.io_class = (
+            IOPRIO_CLASS_IDLE if self.pressure >= IDLE_PRESSURE else IOPRIO_CLASS_BE
+        )
+        return self.rate
+
+    def acquire(self, nbytes: int):
+        """Block the calling thread until nbytes fit in the current rate."""
+        with self._lock:
+            now = time.monotonic()
+            rate = max(self.rate, 1)
+            # Allow at most one second of burst
+            self._allowance = min(rate, self._allowance + (now - self._checked) * rate)
+            self._checked = now
+            self._allowance -= nbytes
+            wait = -self._allowance / rate if self._allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def apply_io_priority(self, pid: int = 0):
+        """Apply the current I/O class to the calling thread, or to a process
+        and its children."""
+        if not pid:
+            set_io_priority(self.io_class)
+            return
+        for child in process_tree(pid):
+            set_io_priority(self.io_class, pid=child)
+
+    def rsync_args(self) -> list[str]:
+        return [f"--bwlimit={max(self.rate // 1024, 1)}"]
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from asyncio.subprocess import DEVNULL, PIPE
+from logging import Logger
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# Seconds between two health checks of the connections to remote targets
+CHECK_INTERVAL = 60
+
+# Seconds allowed to connect to a remote target
+CONNECT_TIMEOUT = 15
+
+DAEMON_PORT = 873
+
+# [user@]host:path, the remote shell syntax of rsync
+SSH_TARGET_RE = re.compile(r"^(?:(?P<user>[^@/:]+)@)?(?P<host>[^@/:]+):(?P<path>.*)$")
+
+
+class LocalTransport:
+    """Rsync to a local (or mounted) destination path."""
+
+    remote = False
+
+    def __init__(self, path: Path):
+        self.target = str(path)
+
+    def rsync_args(self) -> list[str]:
+        return []
+
+    async def connect(self) -> bool:
+        return True
+
+    async def close(self):
+        pass
+
+
+class DaemonTransport:
+    """Rsync to an rsync daemon, ``rsync://[user@]host[:port]/module/path``.
+
+    Runs skip the remote shell and its handshake. The daemon is checked by
+    reading its greeting; the password of auth users comes from RSYNC_PASSWORD.
+    """
+
+    remote = True
+
+    def __init__(self, target: str, logger: Logger):
+        parts = urlsplit(target)
+        self.target = target
+        self.host = parts.hostname
+        self.port = parts.port or DAEMON_PORT
+        self.logger = logger
+
+    def rsync_args(self) -> list[str]:
+        return [f"--contimeout={CONNECT_TIMEOUT}"]
+
+    async def connect(self) -> bool:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.warning(
+                f"rsync daemon {self.host}:{self.port} unreachable: {e}"
+            )
+            return False
+        try:
+            greeting = await asyncio.wait_for(reader.readline(), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            greeting = b""
+        finally:
+            writer.close()
+        if not greeting.startswith(b"@RSYNCD:"):
+            self.logger.warning(
+                f"{self.host}:{self.port} did not answer as an rsync daemon"
+            )
+            return False
+        return True
+
+    async def close(self):
+        pass
+
+
+class SSHTransport:
+    """Rsync over a persistent, multiplexed SSH connection, ``[user@]host:path``.
+
+    A master connection is kept open on a control socket and every rsync run
+    opens a channel on it, saving the TCP and SSH handshakes. ``connect``
+    checks the master and starts a new one when it died; runs fall back to
+    their own connection if the master is gone.
+    """
+
+    remote = True
+
+    def __init__(self, target: str, logger: Logger):
+        match = SSH_TARGET_RE.match(target)
+        self.target = target
+        self.destination = (
+            f"{match['user']}@{match['host']}" if match["user"] else match["host"]
+        )
+        key = hashlib.sha1(target.encode(), usedforsecurity=False).hexdigest()[:12]
+        self.socket = os.path.join(
+            tempfile.gettempdir(), f"qbrouter-ssh-{os.getpid()}-{key}"
+        )
+        self.logger = logger
+        self._master: asyncio.subprocess.Process | None = None
+        self._lock = asyncio.Lock()
+
+    def rsync_args(self) -> list[str]:
+        return ["--rsh", f"ssh -S {self.socket} -o ControlMaster=no"]
+
+    async def _control(self, command: str) -> int:
+        process = await asyncio.create_subprocess_exec(
+            "ssh",
+            "-S",
+            self.socket,
+            "-O",
+            command,
+            self.destination,
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        return await process.wait()
+
+    async def _stop_master(self):
+        if self._master and self._master.returncode is None:
+            self._master.terminate()
+            await self._master.wait()
+        self._master = None
+
+    async def connect(self) -> bool:
+        async with self._lock:
+            if self._master and self._master.returncode is None:
+                if await self._control("check") == 0:
+                    return True
+                self.logger.warning(f"SSH connection to {self.destination} is dead")
+            await self._stop_master()
+
+            self.logger.info(f"Opening SSH connection to {self.destination}")
+            self._master = await asyncio.create_subprocess_exec(
+                "ssh",
+                "-M",
+                "-N",
+                "-S",
+                self.socket,
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                f"ConnectTimeout={CONNECT_TIMEOUT}",
+                "-o",
+                "ServerAliveInterval=15",
+                "-o",
+                "ServerAliveCountMax=3",
+                self.destination,
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=PIPE,
+            )
+            # The master is ready once it answers on its control socket
+            for _ in range(CONNECT_TIMEOUT * 10):
+                if self._master.returncode is not None:
+                    error = await self._master.stderr.read()
+                    self.logger.warning(
+                        f"SSH connection to {self.destination} failed: "
+                        f"{error.decode(errors='replace').strip()}"
+                    )
+                    self._master = None
+                    return False
+                if os.path.exists(self.socket) and await self._control("check") == 0:
+                    return True
+                await asyncio.sleep(0.1)
+
+            self.logger.warning(f"SSH connection to {self.destination} timed out")
+            await self._stop_master()
+            return False
+
+    async def close(self):
+        async with self._lock:
+            if self._master and self._master.returncode is None:
+                await self._control("exit")
+            await self._stop_master()
+
+
+def open_transport(path: Path, target: str | None, logger: Logger):
+    """Return the transport rsync uses to reach a destination: its remote
+    target when set, its path otherwise."""
+    if not target:
+        return LocalTransport(path)
+    if target.startswith("rsync://"):
+        return DaemonTransport(target, logger)
+    if SSH_TARGET_RE.match(target):
+        return SSHTransport(target, logger)
+    raise ValueError(f"Unsupported rsync target {target}")
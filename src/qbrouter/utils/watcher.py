@@ -1,8 +1,11 @@
 import asyncio
+import errno
+import os
+import time
 from asyncio import Event as AsyncioEvent
 from logging import Logger
 from pathlib import Path
-from typing import Generator, AsyncGenerator, TYPE_CHECKING
+from typing import Generator, AsyncGenerator, NamedTuple, TYPE_CHECKING
 from unittest.mock import Mock
 
 try:
@@ -20,6 +23,9 @@ except AttributeError as e:
     Mask.MOVED_TO = 4
     Mask.DELETE_SELF = 5
     Mask.IGNORED = 6
+    Mask.Q_OVERFLOW = 7
+    Mask.ISDIR = 8
+    Mask.CLOSE_WRITE = 9
 
     # Ensure the Mask mock supports bitwise operations
     Mask.__or__ = lambda self, other: self
@@ -31,6 +37,9 @@ except AttributeError as e:
         Mask.MOVED_TO,
         Mask.DELETE_SELF,
         Mask.IGNORED,
+        Mask.Q_OVERFLOW,
+        Mask.ISDIR,
+        Mask.CLOSE_WRITE,
     ]
     Mask.__eq__ = lambda self, other: str(self) == str(other)
     Mask.__str__ = lambda self: "Mask"
@@ -64,64 +73,156 @@ except AttributeError as e:
     Event.return_value = Event
 
 
-def get_directories_recursive(path: Path) -> Generator[Path, None, None]:
-    if path.is_dir():
-        yield path
-        for child in path.iterdir():
-            yield from get_directories_recursive(child)
+# Seconds a subtree counts as recently active for overflow rescans
+ACTIVE_WINDOW = 300
+
+
+class Rescan(NamedTuple):
+    """Synthetic event asking consumers to resync a whole subtree."""
+
+    path: Path
+    mask: Mask = Mask.Q_OVERFLOW
 
 
-async def watch_path(path: Path, logger: Logger) -> AsyncGenerator[Event, None]:
-    mask = Mask.CREATE | Mask.MOVE
+def get_directories_recursive(path: Path) -> Generator[Path, None, None]:
+    """Yield path and every directory below it, parents before their children.
+
+    Uses an explicit stack and ``os.scandir`` (d_type, no stat per entry) so
+    deep trees neither recurse nor overflow the Python stack.
+    """
+    if not path.is_dir():
+        return
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        yield directory
+        try:
+            with os.scandir(directory) as entries:
+                children = [
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                ]
+        except OSError:
+            continue
+        stack.extend(reversed(children))
+
+
+class WatchTable:
+    """wd -> path table for the directory watches of one inotify instance."""
+
+    def __init__(self, inotify: Inotify, mask: Mask, logger: Logger):
+        self.inotify = inotify
+        self.mask = mask
+        self.logger = logger
+        self.watches = {}
+
+    def add(self, directory: Path):
+        try:
+            watch = self.inotify.add_watch(directory, self.mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                self.logger.error(
+                    f"Cannot watch {directory}: inotify watch limit reached, "
+                    "raise fs.inotify.max_user_watches"
+                )
+            else:
+                self.logger.debug(f"Cannot watch {directory}: {e}")
+            return
+        if watch is not None:
+            self.watches[watch.wd] = watch
+
+    def add_tree(self, root: Path) -> int:
+        count = 0
+        for directory in get_directories_recursive(root):
+            self.add(directory)
+            count += 1
+        return count
+
+    def discard(self, wd: int):
+        self.watches.pop(wd, None)
+
+    def move(self, old: Path, new: Path):
+        """Repoint the watches of a directory renamed inside the tree."""
+        for watch in self.watches.values():
+            if watch.path == old or old in watch.path.parents:
+                watch.path = new / watch.path.relative_to(old)
+
+
+async def watch_path(
+    path: Path, logger: Logger
+) -> AsyncGenerator[Event | Rescan, None]:
+    # Files are synced when created and again once written, as qBittorrent
+    # creates them before their data is downloaded
+    mask = Mask.CREATE | Mask.MOVE | Mask.CLOSE_WRITE
     with Inotify() as inotify:
-        for directory in get_directories_recursive(path):
-            logger.debug(f"init watching {directory}")
-            inotify.add_watch(
-                directory,
-                mask
-                | Mask.MOVED_FROM
-                | Mask.MOVED_TO
-                | Mask.CREATE
-                | Mask.DELETE_SELF
-                | Mask.IGNORED,
-            )
+        table = WatchTable(
+            inotify,
+            mask
+            | Mask.MOVED_FROM
+            | Mask.MOVED_TO
+            | Mask.CREATE
+            | Mask.DELETE_SELF
+            | Mask.IGNORED,
+            logger,
+        )
+        start_time = time.monotonic()
+        count = await asyncio.to_thread(table.add_tree, path)
+        logger.info(
+            f"Watching {count} directories under {path} "
+            f"({time.monotonic() - start_time:.1f}s)"
+        )
+
+        # Directories moved away, by cookie, to match with their MOVED_TO
+        moved_from = {}
+        # Top-level subtrees by the time they last had an event
+        active = {}
 
         async for event in inotify:
-
-            # Add subdirectories to watch if a new directory is added.  We do
-            # this recursively here before processing events to make sure we
-            # have complete coverage of existing and newly-created directories
-            # by watching before recursing and adding, since we know
-            # get_directories_recursive is depth-first and yields every
-            # directory before iterating their children, we know we won't miss
-            # anything.
-            if (
-                Mask.CREATE in event.mask
-                and event.path is not None
-                and event.path.is_dir()
-            ):
-                for directory in get_directories_recursive(event.path):
-                    logger.debug(f"add watching {directory}")
-                    inotify.add_watch(
-                        directory,
-                        mask
-                        | Mask.MOVED_FROM
-                        | Mask.MOVED_TO
-                        | Mask.CREATE
-                        | Mask.DELETE_SELF
-                        | Mask.IGNORED,
-                    )
+            if Mask.Q_OVERFLOW in event.mask:
+                # Events were dropped; rescan the subtrees that were busy
+                # recently, or everything if we do not know of any.
+                now = time.monotonic()
+                subtrees = [
+                    subtree
+                    for subtree, seen in active.items()
+                    if now - seen < ACTIVE_WINDOW
+                ] or [path]
+                logger.warning(
+                    f"Inotify queue overflowed, rescanning {len(subtrees)} subtrees"
+                )
+                for subtree in subtrees:
+                    await asyncio.to_thread(table.add_tree, subtree)
+                    yield Rescan(subtree)
+                continue
+
+            if Mask.IGNORED in event.mask:
+                if event.watch is not None:
+                    table.discard(event.watch.wd)
+                continue
+
+            if event.path is not None and path in event.path.parents:
+                active[path / event.path.relative_to(path).parts[0]] = time.monotonic()
+
+            if Mask.ISDIR in event.mask and event.path is not None:
+                if Mask.MOVED_FROM in event.mask:
+                    if len(moved_from) > 1024:
+                        moved_from.clear()
+                    moved_from[event.cookie] = event.path
+                elif Mask.MOVED_TO in event.mask and event.cookie in moved_from:
+                    # Renamed inside the tree, the kernel keeps its watches
+                    table.move(moved_from.pop(event.cookie), event.path)
+                elif Mask.CREATE in event.mask or Mask.MOVED_TO in event.mask:
+                    # Watch new and moved-in directories. get_directories_recursive
+                    # yields every directory before scanning its children, and
+                    # each one is watched before the next is scanned, so we won't
+                    # miss directories created in the meantime.
+                    for directory in get_directories_recursive(event.path):
+                        logger.debug(f"add watching {directory}")
+                        table.add(directory)
 
             # If there is at least some overlap, assume the user wants this event.
             if event.mask & mask:
                 yield event
             else:
-                # Note that these events are needed for cleanup purposes.
-                # We'll always get IGNORED events so the watch can be removed
-                # from the inotify.  We don't need to do anything with the
-                # events, but they do need to be generated for cleanup.
-                # We don't need to pass IGNORED events up, because the end-user
-                # doesn't have the inotify instance anyway, and IGNORED is just
-                # used for management purposes.
                 logger.debug(f"unyielded event: {event}")
-                # inotify.rm_watch(event.watch)